@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""
+announcements.py -- incrementally tracked nearly sold out conferences
+
+A single NearSoldOut entity holds the conferences with 1 to
+NEARLY_SOLD_OUT seats left, the announcement listing them and a version
+number that grows with every change. Registrations report the seat
+count of their conference through seatsChanged(); only when it crosses
+the threshold is the set updated and the announcement regenerated.
+The current state is cached in memcache, replaced only by newer
+versions, so readers never see an older announcement once a newer one
+was cached.
+
+reconcile(), run by the announcement cron, catches conferences whose
+seats changed without a registration (e.g. new or updated ones).
+
+"""
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import NearSoldOut
+
+import seats
+
+NEARLY_SOLD_OUT = 5             # seats
+MEMCACHE_NEAR_SOLD_OUT_KEY = "NEAR_SOLD_OUT"
+ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
+                    'are nearly sold out: %s')
+
+
+def _stateKey():
+    return ndb.Key(NearSoldOut, 'announcement')
+
+
+def _toState(entity):
+    return {'version': entity.version,
+            'conferences': entity.conferences or {},
+            'announcement': entity.announcement}
+
+
+def _cacheState(state):
+    """Cache state unless a newer version is cached already."""
+    client = memcache.Client()
+    for _ in range(3):
+        cached = client.gets(MEMCACHE_NEAR_SOLD_OUT_KEY)
+        if cached is None:
+            if client.add(MEMCACHE_NEAR_SOLD_OUT_KEY, state):
+                return
+        elif cached['version'] >= state['version']:
+            return
+        elif client.cas(MEMCACHE_NEAR_SOLD_OUT_KEY, state):
+            return
+    memcache.delete(MEMCACHE_NEAR_SOLD_OUT_KEY)
+
+
+def getState():
+    """Return the current state dict with version, conferences (websafe
+    key -> name) and announcement."""
+    state = memcache.get(MEMCACHE_NEAR_SOLD_OUT_KEY)
+    if state is None:
+        state = _toState(_stateKey().get() or NearSoldOut())
+        _cacheState(state)
+    return state
+
+
+def getAnnouncement():
+    """Return the current announcement, or an empty string."""
+    return getState()['announcement']
+
+
+def isNearlySoldOut(seatsAvailable):
+    return 0 < seatsAvailable <= NEARLY_SOLD_OUT
+
+
+@ndb.transactional()
+def _apply(changes):
+    """Apply {websafe key: name or None} to the stored set.
+
+    Regenerates the announcement and bumps the version if the set
+    changed; returns the new state.
+    """
+    entity = _stateKey().get() or NearSoldOut(key=_stateKey())
+    conferences = dict(entity.conferences or {})
+    for wsck, name in changes.items():
+        if name is None:
+            conferences.pop(wsck, None)
+        else:
+            conferences[wsck] = name
+    if conferences != (entity.conferences or {}):
+        entity.conferences = conferences
+        entity.announcement = (
+            ANNOUNCEMENT_TPL % ', '.join(sorted(conferences.values()))
+            if conferences else '')
+        entity.version += 1
+        entity.put()
+    return _toState(entity)
+
+
+def seatsChanged(conf):
+    """Update the set if conf crossed the nearly sold out threshold."""
+    nearly = isNearlySoldOut(seats.getSeatsAvailable(conf))
+    wsck = conf.key.urlsafe()
+    if nearly == (wsck in getState()['conferences']):
+        return
+    _cacheState(_apply({wsck: conf.name if nearly else None}))
+
+
+def reconcile():
+    """Recheck the tracked conferences and those the datastore reports
+    as nearly sold out; returns the announcement."""
+    state = getState()
+    keys = set(Conference.query(ndb.AND(
+        Conference.seatsAvailable <= NEARLY_SOLD_OUT,
+        Conference.seatsAvailable > 0)).fetch(keys_only=True))
+    keys.update(ndb.Key(urlsafe=wsck) for wsck in state['conferences'])
+    keys = list(keys)
+    changes = {}
+    for conf_key, conf in zip(keys, ndb.get_multi(keys)):
+        wsck = conf_key.urlsafe()
+        if conf and isNearlySoldOut(seats.getSeatsAvailable(conf)):
+            if state['conferences'].get(wsck) != conf.name:
+                changes[wsck] = conf.name
+        elif wsck in state['conferences']:
+            changes[wsck] = None
+    if changes:
+        state = _apply(changes)
+        _cacheState(state)
+    return state['announcement']
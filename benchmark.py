@@ -0,0 +1,499 @@
+#!/usr/bin/env python
+
+"""
+benchmark.py -- latency benchmark of ConferenceApi endpoints
+
+Runs the endpoints in-process on the App Engine testbed stubs
+(datastore_v3, memcache, taskqueue, urlfetch, ...), after seeding
+synthetic conferences, speakers, sessions and profiles, and reports
+per endpoint the p50/p95/p99 latency, the datastore and memcache RPCs
+per call and the memcache hit ratio.
+
+usage: python benchmark.py --sdk ~/google_appengine [--conferences 50]
+           [--sessions 20] [--speakers 30] [--users 100] [--calls 200]
+           [--seed 1] [--layout ancestor|flat] [--json]
+       python benchmark.py --contention [--threads 8] [--hot 3] ...
+
+Every call runs with a fresh ndb context cache and a new ConferenceApi
+instance, like a separate request. Tasks are queued but not executed,
+so snapshots and caches are only built on demand by the endpoints; the
+search index is built once while seeding. --layout selects the Session
+key layout of sessionkeys.py.
+
+With --contention, --threads threads instead run --calls operations
+each against the --hot conferences with the most seats: createSession
+as the organizer, or registerForConference followed by
+unregisterFromConference as a user. It runs once per key layout (or
+only for --layout) and reports throughput, latencies, and transaction
+commits and conflicts (commits failed because the entity group changed
+since the transaction read it). The stubs detect such conflicts like
+the datastore, but do not limit the write rate of an entity group.
+
+"""
+
+import argparse
+import collections
+import datetime
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+
+APP_ID = 'nd-conf-org'
+CITIES = ['London', 'Paris', 'Tokyo', 'Chicago', 'San Francisco', 'Berlin']
+TOPICS = ['Medical Innovations', 'Programming Languages', 'Web Technologies',
+          'Movie Making', 'Health and Nutrition']
+SESSION_TYPES = ['LECTURE', 'KEYNOTE', 'WORKSHOP', 'NOT_SPECIFIED']
+
+
+def _setupPath(sdk):
+    """Put the App Engine SDK and its bundled libraries on sys.path."""
+    if sdk:
+        sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def _activateTestbed():
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(app_id=APP_ID, overwrite=True)
+    bed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util
+            .PseudoRandomHRConsistencyPolicy(probability=1))
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.abspath(__file__)))
+    bed.init_urlfetch_stub()
+    bed.init_app_identity_stub()
+    bed.init_mail_stub()
+    bed.init_user_stub()
+    return bed
+
+
+class RpcCounter(object):
+    """Count API calls per service through an apiproxy pre-call hook."""
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.enabled = False
+
+    def hook(self, service, call, request, response):
+        if self.enabled:
+            self.counts[service] += 1
+
+    def install(self):
+        from google.appengine.api import apiproxy_stub_map
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'benchmark', self.hook)
+
+
+def _actAs(email):
+    """Make endpoints.get_current_user() return the user with email."""
+    os.environ['ENDPOINTS_AUTH_EMAIL'] = email
+    os.environ['ENDPOINTS_AUTH_DOMAIN'] = 'gmail.com'
+
+
+def seed(args, rnd):
+    """Store the synthetic data set; returns a dict of its keys."""
+    from google.appengine.ext import ndb
+    from models import Conference, Profile, Session, Speaker
+    import search
+    import seats
+    import sessionkeys
+
+    users = ['user%d@example.com' % i for i in range(args.users)]
+    ndb.put_multi([Profile(key=ndb.Key(Profile, email),
+                           displayName='User %d' % i, mainEmail=email)
+                   for i, email in enumerate(users)])
+
+    organizer = ndb.Key(Profile, users[0])
+    speaker_keys = ndb.put_multi([
+        Speaker(parent=organizer, name='Speaker %d' % i)
+        for i in range(args.speakers)])
+
+    conferences = []
+    sessions = []
+    sessions_of = {}
+    start = datetime.date(2016, 1, 1)
+    for i in range(args.conferences):
+        owner = ndb.Key(Profile, rnd.choice(users))
+        startDate = start + datetime.timedelta(days=rnd.randrange(365))
+        maxAttendees = rnd.choice([5, 20, 100, 1000])
+        conf = Conference(
+            parent=owner, name='Conference %d' % i,
+            description='Synthetic conference %d' % i,
+            organizerUserId=owner.id(), organizerDisplayName='Organizer',
+            topics=rnd.sample(TOPICS, 2), city=rnd.choice(CITIES),
+            startDate=startDate, month=startDate.month,
+            endDate=startDate + datetime.timedelta(days=2),
+            maxAttendees=maxAttendees, seatsAvailable=maxAttendees)
+        conf_key = conf.put()
+        seats.createShards(conf_key, maxAttendees)
+        conferences.append(conf_key)
+        sess_keys = (sessionkeys.allocateKeys(conf_key, args.sessions)
+                     if args.sessions else [])
+        sessions_of[conf_key] = ndb.put_multi([
+            Session(key=sess_key, conferenceKey=conf_key,
+                    name='Session %d-%d' % (i, j),
+                    highlight=['highlight %d' % (j % 5)],
+                    speaker=rnd.sample(speaker_keys,
+                                       min(2, len(speaker_keys))),
+                    date=startDate + datetime.timedelta(days=j % 3),
+                    startTime=datetime.time(rnd.randrange(8, 20),
+                                            rnd.choice([0, 30])),
+                    durationInMins=rnd.choice([30, 60, 90]),
+                    typeOfSession=rnd.choice(SESSION_TYPES),
+                    location='Room %d' % (j % 4))
+            for j, sess_key in enumerate(sess_keys)])
+        sessions.extend(sessions_of[conf_key])
+    search.indexDocuments(conferences + sessions)
+    return {'users': users, 'conferences': conferences,
+            'sessions': sessions, 'sessionsOf': sessions_of}
+
+
+def scenarios(data, rnd):
+    """Return {endpoint name: function(api) -> response}."""
+    from protorpc import message_types
+    from conference import (CONF_GET_REQUEST, CONF_LIST_REQUEST,
+                            SEARCH_REQUEST, SESS_GET_REQUEST,
+                            SESS_LIST_REQUEST, SESS_SEARCH_REQUEST)
+    from models import QueryForm, QueryForms
+
+    def confRequest(container, **fields):
+        conf_key = rnd.choice(data['conferences'])
+        return container.combined_message_class(
+            websafeConferenceKey=conf_key.urlsafe(), **fields)
+
+    def sessRequest():
+        conf_key = rnd.choice(data['conferences'])
+        sess_key = rnd.choice(data['sessionsOf'][conf_key])
+        return SESS_GET_REQUEST.combined_message_class(
+            websafeConferenceKey=conf_key.urlsafe(),
+            sessionId=str(sess_key.id()))
+
+    return collections.OrderedDict([
+        ('queryConferences', lambda api: api.queryConferences(QueryForms(
+            filters=[QueryForm(field='CITY', operator='EQ',
+                               value=rnd.choice(CITIES)),
+                     QueryForm(field='MAX_ATTENDEES', operator='GT',
+                               value='10')],
+            pageSize=20))),
+        ('getConference', lambda api: api.getConference(
+            confRequest(CONF_GET_REQUEST))),
+        ('getConferenceSessions', lambda api: api.getConferenceSessions(
+            confRequest(SESS_LIST_REQUEST))),
+        ('getConferenceSchedule', lambda api: api.getConferenceSchedule(
+            confRequest(CONF_GET_REQUEST))),
+        ('registerForConference', lambda api: api.registerForConference(
+            confRequest(CONF_GET_REQUEST))),
+        ('getConferencesToAttend', lambda api: api.getConferencesToAttend(
+            CONF_LIST_REQUEST.combined_message_class(pageSize=20))),
+        ('addSessionToWishlist', lambda api: api.addSessionToWishlist(
+            sessRequest())),
+        ('getSessionsInWishlist', lambda api: api.getSessionsInWishlist(
+            CONF_LIST_REQUEST.combined_message_class(pageSize=20))),
+        ('searchConferences', lambda api: api.searchConferences(
+            SEARCH_REQUEST.combined_message_class(
+                query='%s %s' % (rnd.choice(TOPICS), rnd.choice(CITIES)),
+                pageSize=20))),
+        ('searchSessions', lambda api: api.searchSessions(
+            SESS_SEARCH_REQUEST.combined_message_class(
+                query='highlight %d room' % rnd.randrange(5),
+                pageSize=20))),
+        ('getProfile', lambda api: api.getProfile(
+            message_types.VoidMessage())),
+        ('getAnnouncement', lambda api: api.getAnnouncement(
+            message_types.VoidMessage())),
+    ])
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of sorted values."""
+    if not values:
+        return 0.0
+    index = max(0, int(math.ceil(fraction * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def run(args):
+    _setupPath(args.sdk)
+    bed = _activateTestbed()
+    try:
+        import endpoints
+        from google.appengine.api import memcache
+        from google.appengine.ext import ndb
+        from conference import ConferenceApi
+        import sessionkeys
+
+        if args.layout:
+            sessionkeys.setLayout(args.layout)
+        rnd = random.Random(args.seed)
+        data = seed(args, rnd)
+        counter = RpcCounter()
+        counter.install()
+
+        results = collections.OrderedDict()
+        for name, call in scenarios(data, rnd).items():
+            latencies = []
+            errors = 0
+            counter.counts.clear()
+            before = memcache.get_stats()
+            for _ in range(args.calls):
+                _actAs(rnd.choice(data['users']))
+                ndb.get_context().clear_cache()
+                api = ConferenceApi()
+                counter.enabled = True
+                started = time.time()
+                try:
+                    call(api)
+                except endpoints.ServiceException:
+                    # e.g. registering twice or a sold out conference
+                    errors += 1
+                finally:
+                    latencies.append((time.time() - started) * 1000)
+                    counter.enabled = False
+            after = memcache.get_stats()
+            hits = after['hits'] - before['hits']
+            misses = after['misses'] - before['misses']
+            latencies.sort()
+            results[name] = {
+                'calls': args.calls,
+                'errors': errors,
+                'p50Ms': percentile(latencies, 0.50),
+                'p95Ms': percentile(latencies, 0.95),
+                'p99Ms': percentile(latencies, 0.99),
+                'datastoreRpcs': float(counter.counts['datastore_v3'])
+                    / args.calls,
+                'memcacheRpcs': float(counter.counts['memcache'])
+                    / args.calls,
+                'memcacheHitRatio': (float(hits) / (hits + misses)
+                                     if hits + misses else None),
+            }
+        return results
+    finally:
+        bed.deactivate()
+
+
+class TxnCounter(object):
+    """Count transaction commits and failed commits per operation of the
+    calling thread through apiproxy hooks."""
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.commits = collections.Counter()
+        self.committed = collections.Counter()
+
+    def _isCommit(self, service, call):
+        return (service, call) == ('datastore_v3', 'Commit')
+
+    def preCall(self, service, call, request, response):
+        op = getattr(self.local, 'op', None)
+        if op and self._isCommit(service, call):
+            with self.lock:
+                self.commits[op] += 1
+
+    def postCall(self, service, call, request, response, rpc=None,
+                 error=None):
+        op = getattr(self.local, 'op', None)
+        if op and self._isCommit(service, call) and error is None:
+            with self.lock:
+                self.committed[op] += 1
+
+    def install(self):
+        from google.appengine.api import apiproxy_stub_map
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'contention', self.preCall)
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'contention', self.postCall)
+
+
+def contentionOperations(hot):
+    """Return {operation name: function(rnd, users) -> (email,
+    function(api))} of the contention run."""
+    from conference import CONF_GET_REQUEST, SESS_CREATE_REQUEST
+
+    def createSession(rnd, users):
+        conf_key = rnd.choice(hot)
+        request = SESS_CREATE_REQUEST.combined_message_class(
+            websafeConferenceKey=conf_key.urlsafe(),
+            name='Session %d' % rnd.randrange(10 ** 6),
+            highlight=['highlight %d' % rnd.randrange(5)],
+            location='Room %d' % rnd.randrange(4))
+        # the organizer's profile id is the email
+        return conf_key.parent().id(), lambda api: api.createSession(request)
+
+    def registerAndUnregister(rnd, users):
+        request = CONF_GET_REQUEST.combined_message_class(
+            websafeConferenceKey=rnd.choice(hot).urlsafe())
+
+        def call(api):
+            api.registerForConference(request)
+            api.unregisterFromConference(request)
+        return rnd.choice(users), call
+
+    return collections.OrderedDict([
+        ('createSession', createSession),
+        ('registerAndUnregister', registerAndUnregister),
+    ])
+
+
+def runContention(args, layout):
+    """Run the contention operations concurrently in one key layout."""
+    _setupPath(args.sdk)
+    bed = _activateTestbed()
+    try:
+        import endpoints
+        from google.appengine.api import datastore_errors
+        from google.appengine.ext import ndb
+        from conference import ConferenceApi
+        import sessionkeys
+
+        sessionkeys.setLayout(layout)
+        data = seed(args, random.Random(args.seed))
+        hot = [conf.key for conf in sorted(
+                   ndb.get_multi(data['conferences']),
+                   key=lambda conf: -conf.maxAttendees)[:args.hot]]
+        operations = contentionOperations(hot)
+        counter = TxnCounter()
+        counter.install()
+        latencies = dict((name, []) for name in operations)
+        errors = collections.Counter()
+        lock = threading.Lock()
+
+        def worker(index):
+            rnd = random.Random(args.seed * 1000 + index)
+            # a user is registered by one thread only
+            users = data['users'][index::args.threads] or data['users']
+            for _ in range(args.calls):
+                name = rnd.choice(list(operations))
+                email, call = operations[name](rnd, users)
+                ndb.get_context().clear_cache()
+                api = ConferenceApi()
+                with lock:
+                    # endpoints reads the user from os.environ, which all
+                    # threads share; the api keeps it once resolved
+                    _actAs(email)
+                    api._getUser()
+                counter.local.op = name
+                started = time.time()
+                try:
+                    call(api)
+                except (endpoints.ServiceException,
+                        datastore_errors.TransactionFailedError):
+                    # e.g. a sold out conference or too many conflicts
+                    with lock:
+                        errors[name] += 1
+                finally:
+                    elapsed = (time.time() - started) * 1000
+                    counter.local.op = None
+                    with lock:
+                        latencies[name].append(elapsed)
+
+        threads = [threading.Thread(target=worker, args=(index,))
+                   for index in range(args.threads)]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+
+        results = collections.OrderedDict()
+        for name in operations:
+            values = sorted(latencies[name])
+            results[name] = {
+                'calls': len(values),
+                'errors': errors[name],
+                'p50Ms': percentile(values, 0.50),
+                'p95Ms': percentile(values, 0.95),
+                'p99Ms': percentile(values, 0.99),
+                'commits': counter.commits[name],
+                'conflicts': counter.commits[name] - counter.committed[name],
+            }
+        return {'threads': args.threads,
+                'hotConferences': len(hot),
+                'opsPerSec': (args.threads * args.calls / elapsed
+                              if elapsed else 0.0),
+                'operations': results}
+    finally:
+        bed.deactivate()
+
+
+def reportContention(results):
+    print ('%-9s %-22s %6s %6s %9s %9s %9s %8s %9s'
+           % ('layout', 'operation', 'calls', 'errors', 'p50 ms', 'p95 ms',
+              'p99 ms', 'commits', 'conflicts'))
+    for layout, result in results.items():
+        for name, r in result['operations'].items():
+            print ('%-9s %-22s %6d %6d %9.2f %9.2f %9.2f %8d %9d'
+                   % (layout, name, r['calls'], r['errors'], r['p50Ms'],
+                      r['p95Ms'], r['p99Ms'], r['commits'], r['conflicts']))
+        print ('%-9s %d threads, %d hot conferences: %.1f operations/s'
+               % (layout, result['threads'], result['hotConferences'],
+                  result['opsPerSec']))
+
+
+def report(results):
+    print ('%-24s %6s %6s %9s %9s %9s %8s %8s %6s'
+           % ('endpoint', 'calls', 'errors', 'p50 ms', 'p95 ms', 'p99 ms',
+              'ds rpc', 'mc rpc', 'hit %'))
+    for name, r in results.items():
+        ratio = r['memcacheHitRatio']
+        print ('%-24s %6d %6d %9.2f %9.2f %9.2f %8.1f %8.1f %6s'
+               % (name, r['calls'], r['errors'], r['p50Ms'], r['p95Ms'],
+                  r['p99Ms'], r['datastoreRpcs'], r['memcacheRpcs'],
+                  '%.0f' % (ratio * 100) if ratio is not None else '-'))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark ConferenceApi endpoints on testbed stubs.')
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='path of the App Engine Python SDK')
+    parser.add_argument('--conferences', type=int, default=50)
+    parser.add_argument('--sessions', type=int, default=20,
+                        help='sessions per conference')
+    parser.add_argument('--speakers', type=int, default=30)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--calls', type=int, default=200,
+                        help='calls per endpoint, or per thread of the '
+                             'contention run')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--layout', choices=['ancestor', 'flat'],
+                        help='Session key layout (default: settings.py)')
+    parser.add_argument('--contention', action='store_true',
+                        help='run concurrent session creation and '
+                             'registration per key layout')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='threads of the contention run')
+    parser.add_argument('--hot', type=int, default=3,
+                        help='conferences targeted by the contention run')
+    parser.add_argument('--json', action='store_true',
+                        help='print results as JSON')
+    args = parser.parse_args()
+    if args.contention:
+        results = collections.OrderedDict(
+            (layout, runContention(args, layout))
+            for layout in ([args.layout] if args.layout
+                           else ['ancestor', 'flat']))
+    else:
+        results = run(args)
+    if args.json:
+        print json.dumps(results, indent=2)
+    elif args.contention:
+        reportContention(results)
+    else:
+        report(results)
+
+
+if __name__ == '__main__':
+    main()
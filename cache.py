@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""
+cache.py -- read-through memcache layer for single entity lookups
+
+Serialized outbound forms (ConferenceForm, SessionFormOut,
+SpeakerFormOut) are stored in memcache keyed by kind and websafe key.
+Writers invalidate the entries they touch; invalidation from inside a
+transaction is deferred until the transaction has committed.
+
+A miss leaves a placeholder, and the Entry returned by read() keeps its
+compare-and-set id in a memcache client of its own while the entity is
+read; Entry.store() then stores the form with cas(). A form read before
+a write therefore can't be stored after that write's invalidation,
+which deletes the placeholder and so makes the cas() fail.
+
+"""
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from protorpc import protojson
+
+CONFERENCE = "Conference"
+SESSION = "Session"
+SPEAKER = "Speaker"
+
+# seconds an entry lives in memcache, per kind
+CACHE_TIMES = {
+    CONFERENCE: 600,
+    SESSION: 600,
+    SPEAKER: 3600,
+}
+
+MEMCACHE_ENTITY_KEY = "ENTITY_%s_%s"
+MEMCACHE_HITS_KEY = "ENTITY_HITS_%s"
+MEMCACHE_MISSES_KEY = "ENTITY_MISSES_%s"
+PENDING = "PENDING"
+
+
+def _count(counter_key):
+    """Bump a hit/miss counter without waiting for the result."""
+    memcache.Client().incr_async(counter_key, initial_value=0)
+
+
+class Entry(object):
+    """The cached form of one entity, read by read().
+
+    form is the cached form, or None on a miss. The compare-and-set id
+    of a miss lives in the entry's own memcache client, so nothing is
+    left behind when the entry is dropped without store().
+    """
+
+    def __init__(self, kind, websafeKey, message_type):
+        self.kind = kind
+        self.key = MEMCACHE_ENTITY_KEY % (kind, websafeKey)
+        self.client = memcache.Client()
+        data = self.client.gets(self.key)
+        if data is None:
+            self.client.add(self.key, PENDING, time=CACHE_TIMES[kind])
+            data = self.client.gets(self.key)
+        self.pending = data == PENDING
+        if data is None or self.pending:
+            _count(MEMCACHE_MISSES_KEY % kind)
+            self.form = None
+        else:
+            _count(MEMCACHE_HITS_KEY % kind)
+            self.form = protojson.decode_message(message_type, data)
+
+    def store(self, form):
+        """Store form after a miss, unless the entity was invalidated
+        since the entry was read."""
+        if not self.pending:
+            return
+        self.pending = False
+        self.client.cas(self.key, protojson.encode_message(form),
+                        time=CACHE_TIMES[self.kind])
+
+
+def read(kind, websafeKey, message_type):
+    """Return the Entry of websafeKey; call it before reading the entity,
+    and store() the form built from the entity on a miss."""
+    return Entry(kind, websafeKey, message_type)
+
+
+def invalidate(kind, *websafeKeys):
+    """Drop cached forms; deferred until commit inside a transaction."""
+    keys = [MEMCACHE_ENTITY_KEY % (kind, wsk) for wsk in websafeKeys]
+    if not keys:
+        return
+    if ndb.in_transaction():
+        ndb.get_context().call_on_commit(
+            lambda: memcache.delete_multi(keys))
+    else:
+        memcache.delete_multi(keys)
+
+
+def getStats():
+    """Return a list of (kind, hits, misses) tuples."""
+    counters = []
+    for kind in sorted(CACHE_TIMES):
+        counters.extend([MEMCACHE_HITS_KEY % kind, MEMCACHE_MISSES_KEY % kind])
+    values = memcache.get_multi(counters)
+    return [(kind,
+             int(values.get(MEMCACHE_HITS_KEY % kind) or 0),
+             int(values.get(MEMCACHE_MISSES_KEY % kind) or 0))
+            for kind in sorted(CACHE_TIMES)]
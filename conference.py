@@ -18,13 +18,16 @@ from datetime import datetime
 import endpoints
 from protorpc import messages
 from protorpc import message_types
+from protorpc import protojson
 from protorpc import remote
 
-from google.appengine.api import memcache
+from google.appengine.api import datastore_errors
 from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
 from models import ConflictException
+from models import Attendance
 from models import Profile
 from models import ProfileMiniForm
 from models import ProfileForm
@@ -32,34 +35,60 @@ from models import BooleanMessage
 from models import Conference
 from models import ConferenceForm
 from models import ConferenceForms
+from models import ConferenceSummaryForm
+from models import ListView
 from models import QueryForm
 from models import QueryForms
+from models import ScheduleForm
+from models import SessionConflictForm
 from models import StringMessage
-from models import SessionType
 from models import Session
 from models import SessionFormIn
+from models import SessionFormsIn
 from models import SessionFormOut
 from models import SessionForms
+from models import SessionSummaryForm
 from models import Speaker
 from models import SpeakerFormIn
 from models import SpeakerFormOut
 from models import SpeakerForms
+from models import CacheStatForm
+from models import CacheStatForms
+from models import QueueStatsForm
+from models import NotificationStatsForm
+from models import WishlistEntry
 
 from utils import getUserId
-from utils import get_current_user_id
 
 from settings import WEB_CLIENT_ID
 
+import announcements
+import cache
+import featured
+import notifications
+import queryengine
+import rpcstats
+import schedule
+import search
+import seats
+import sessionkeys
+import textutil
+import timetable
+import userlists
+
 import logging
 
 logging.getLogger().setLevel(logging.DEBUG)
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
-MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
-MEMCACHE_FEATUREDSPEAKER_KEY = "FEATURED_SPEAKER"
-FEATUREDSPEAKER_TPL = (
-    'Speaker %s is our feature speaker, will appear in these sessions: %s')
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+MIGRATION_BATCH_SIZE = 100
+MAX_SESSIONS_BATCH = 500
+MAX_CONFLICTS = 1000
+DEFAULT_SEARCH_LIMIT = 10
+MAX_SEARCH_LIMIT = 50
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -99,11 +128,25 @@ FIELDS_SESS = {
     'LOCATION': 'location',
 }
 
+# converters of filter values for non-string fields
+FIELD_TYPES = {
+    'month': int,
+    'maxAttendees': int,
+    'durationInMins': int,
+    'startTime': lambda value: datetime.strptime(value[:5], "%H:%M").time(),
+}
+
 CONF_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
 )
 
+CONF_LIST_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    pageSize=messages.IntegerField(1, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(2),
+)
+
 CONF_POST_REQUEST = endpoints.ResourceContainer(
     ConferenceForm,
     websafeConferenceKey=messages.StringField(1),
@@ -116,11 +159,31 @@ SESS_GET_REQUEST = endpoints.ResourceContainer(
     sessionId=messages.StringField(2),
 )
 
+SESS_PAGE_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
+)
+
+SESS_LIST_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
+    view=messages.EnumField(ListView, 4, default='FULL'),
+)
+
 SESS_CREATE_REQUEST = endpoints.ResourceContainer(
     SessionFormIn,
     websafeConferenceKey=messages.StringField(1),
 )
 
+SESS_BATCH_REQUEST = endpoints.ResourceContainer(
+    SessionFormsIn,
+    websafeConferenceKey=messages.StringField(1),
+)
+
 SESS_POST_REQUEST = endpoints.ResourceContainer(
     SessionFormIn,
     websafeConferenceKey=messages.StringField(1),
@@ -131,11 +194,15 @@ SESS_GET_BY_TYPE = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
     typeOfSession=messages.StringField(2),
+    pageSize=messages.IntegerField(3, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(4),
 )
 
 SESS_GET_ALL_BY_SPEAKER = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeSpeakerKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
 )
 
 SESS_GET_BY_SPEAKER = endpoints.ResourceContainer(
@@ -148,12 +215,16 @@ SESS_GET_BY_LOCATION = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
     location=messages.StringField(2),
+    pageSize=messages.IntegerField(3, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(4),
 )
 
 SESS_GET_BY_HIGHLIGHT = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
     highlight=messages.StringField(2),
+    pageSize=messages.IntegerField(3, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(4),
 )
 
 SESS_QUERY_FORMS = endpoints.ResourceContainer(
@@ -166,6 +237,36 @@ SPEAKER_GET_REQUEST = endpoints.ResourceContainer(
     websafeSpeakerKey=messages.StringField(1),
 )
 
+SPEAKER_LIST_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    pageSize=messages.IntegerField(1, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(2),
+    view=messages.EnumField(ListView, 3, default='FULL'),
+    mine=messages.BooleanField(4),
+)
+
+SEARCH_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    query=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
+)
+
+SESS_SEARCH_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    query=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
+    websafeConferenceKey=messages.StringField(4),
+)
+
+SPEAKER_SEARCH_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    prefix=messages.StringField(1),
+    limit=messages.IntegerField(2, variant=messages.Variant.INT32),
+    mine=messages.BooleanField(3),
+)
+
 SPEAKER_POST_REQUEST = endpoints.ResourceContainer(
     SpeakerFormIn,
     websafeSpeakerKey=messages.StringField(1),
@@ -180,12 +281,75 @@ SPEAKER_POST_REQUEST = endpoints.ResourceContainer(
 class ConferenceApi(remote.Service):
     """Conference API v0.1"""
 
+# - - - Paging - - - - - - - - - - - - - - - - - - - - - - -
+    def ____PAGING_PART():
+        pass # marked as a divider in function tree view
+
+    def _fetchPage(self, query, request, residual=None, **options):
+        """Fetch the page of query requested by pageSize/pageToken.
+
+        Returns (results, nextPageToken). Without pageSize and pageToken
+        the whole query is returned, as before paging was introduced.
+        Residual filters the datastore cannot run are applied in Python
+        by the query engine; they need full entities, so extra options
+        (e.g. projection) are only passed on to plain fetches.
+        """
+        with rpcstats.phase('query'):
+            if not request.pageSize and not request.pageToken:
+                if residual:
+                    return queryengine.fetchPage(query, residual)[0], None
+                return query.fetch(**options), None
+            page_size = min(request.pageSize or DEFAULT_PAGE_SIZE,
+                            MAX_PAGE_SIZE)
+            if page_size <= 0:
+                raise endpoints.BadRequestException(
+                    "pageSize must be positive")
+            try:
+                cursor = (Cursor(urlsafe=request.pageToken)
+                          if request.pageToken else None)
+                if residual:
+                    results, next_cursor, more = queryengine.fetchPage(
+                        query, residual, page_size, cursor)
+                else:
+                    results, next_cursor, more = query.fetch_page(
+                        page_size, start_cursor=cursor, **options)
+            except (datastore_errors.BadValueError,
+                    datastore_errors.BadRequestError):
+                raise endpoints.BadRequestException("Invalid pageToken")
+            if more and next_cursor:
+                return results, next_cursor.urlsafe()
+            return results, None
+
+    def _pageItems(self, items, request):
+        """Return (page, nextPageToken) of an in-memory list of items.
+
+        pageToken is the offset of the page in the list here.
+        """
+        if not request.pageSize and not request.pageToken:
+            return items, None
+        page_size = min(request.pageSize or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+        if page_size <= 0:
+            raise endpoints.BadRequestException("pageSize must be positive")
+        try:
+            offset = int(request.pageToken or 0)
+        except ValueError:
+            raise endpoints.BadRequestException("Invalid pageToken")
+        if offset < 0:
+            raise endpoints.BadRequestException("Invalid pageToken")
+        if offset + page_size < len(items):
+            return items[offset:offset + page_size], str(offset + page_size)
+        return items[offset:], None
+
 # - - - Conference objects - - - - - - - - - - - - - - - - -
     def ____CONFERENCE_PART():
         pass # marked as a divider in function tree view
 
-    def _copyConferenceToForm(self, conf, displayName):
-        """Copy relevant fields from Conference to ConferenceForm."""
+    def _copyConferenceToForm(self, conf, displayName=None):
+        """Copy relevant fields from Conference to ConferenceForm.
+
+        The organizer's displayName is stored on the Conference itself;
+        a displayName passed in takes precedence over the stored one.
+        """
         cf = ConferenceForm()
         for field in cf.all_fields():
             if hasattr(conf, field.name):
@@ -202,14 +366,20 @@ class ConferenceApi(remote.Service):
         return cf
 
 
+    def _copyConferenceToSummary(self, conf):
+        """Copy projected fields from Conference to ConferenceSummaryForm."""
+        return ConferenceSummaryForm(
+            name=conf.name,
+            startDate=str(conf.startDate) if conf.startDate else None,
+            websafeKey=conf.key.urlsafe())
+
+
     def _createConferenceObject(self, request):
         """Create or update Conference object, returning ConferenceForm/request."""
         """Add a task of sending confirmation email to task queue"""
         # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user = self._getUser()
+        user_id = self._getUserId()
 
         if not request.name:
             raise endpoints.BadRequestException("Conference 'name' field required")
@@ -218,7 +388,6 @@ class ConferenceApi(remote.Service):
         data = {field.name: getattr(request, field.name)
                 for field in request.all_fields()}
         del data['websafeKey']
-        del data['organizerDisplayName']
 
         # add default values for those missing (both data model & outbound Message)
         for df in DEFAULTS_CONF:
@@ -247,22 +416,38 @@ class ConferenceApi(remote.Service):
         c_key = ndb.Key(Conference, c_id, parent=p_key)
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
+        # denormalize organizer displayName, kept in sync by saveProfile()
+        prof = self._getProfileFromUser()
+        data['organizerDisplayName'] = request.organizerDisplayName = (
+            prof.displayName)
+        self._storeNewProfile(prof)
 
         Conference(**data).put()
+        seats.createShards(c_key, data['seatsAvailable'])
+        search.enqueue([c_key])
+        queryengine.bumpGeneration('Conference')
         # create Conference, send email to organizer confirming
         # creation of Conference & return (modified) ConferenceForm
-        # _TODO 2: add confirmation email sending task to queue
-        taskqueue.add(params={'email': user.email(),
-            'conferenceInfo': repr(request)},
-            url='/tasks/send_confirmation_email'
-        )
+        # _TODO 2: add confirmation email to the notification queue
+        notifications.enqueue(user.email(),
+            'You created a new Conference!',
+            'Hi, you have created the following conference:\r\n\r\n%s'
+                % self._formatConferenceInfo(request),
+            c_key.urlsafe())
 
         return request
 
 
-    @ndb.transactional()
+    def _formatConferenceInfo(self, cf):
+        """Format the fields of a ConferenceForm for an email body."""
+        return '\r\n'.join('%s: %s' % (field.name, value)
+            for field, value in ((field, getattr(cf, field.name))
+                                 for field in cf.all_fields())
+            if value not in (None, []))
+
+    @ndb.transactional(xg=True)
     def _updateConferenceObject(self, request):
-        user_id = get_current_user_id()
+        user_id = self._getUserId()
 
         # copy ConferenceForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name)
@@ -283,9 +468,23 @@ class ConferenceApi(remote.Service):
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
         for field in request.all_fields():
+            # organizer fields are not editable, and seatsAvailable
+            # follows from maxAttendees and the registrations
+            if field.name in ('organizerUserId', 'organizerDisplayName',
+                              'seatsAvailable'):
+                continue
             data = getattr(request, field.name)
             # only copy fields where we get data
             if data not in (None, []):
+                # special handling for maxAttendees: the seat shards take
+                # the difference, so registrations are kept
+                if (field.name == 'maxAttendees'
+                        and data != (conf.maxAttendees or 0)):
+                    delta = data - (conf.maxAttendees or 0)
+                    if not seats.adjustSeats(conf, delta):
+                        raise endpoints.BadRequestException(
+                            'maxAttendees is below the registered attendees')
+                    conf.seatsAvailable = (conf.seatsAvailable or 0) + delta
                 # special handling for dates (convert string to Date)
                 if field.name in ('startDate', 'endDate'):
                     data = datetime.strptime(data, "%Y-%m-%d").date()
@@ -294,8 +493,8 @@ class ConferenceApi(remote.Service):
                 # write to Conference object
                 setattr(conf, field.name, data)
         conf.put()
-        prof = ndb.Key(Profile, user_id).get()
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        cache.invalidate(cache.CONFERENCE, request.websafeConferenceKey)
+        return self._copyConferenceToForm(conf)
 
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
@@ -310,7 +509,10 @@ class ConferenceApi(remote.Service):
             http_method='PUT', name='updateConference')
     def updateConference(self, request):
         """Update conference with provided fields & return with updated info."""
-        return self._updateConferenceObject(request)
+        cf = self._updateConferenceObject(request)
+        search.enqueue([ndb.Key(urlsafe=request.websafeConferenceKey)])
+        queryengine.bumpGeneration('Conference')
+        return cf
 
 
     @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
@@ -318,81 +520,108 @@ class ConferenceApi(remote.Service):
             http_method='GET', name='getConference')
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
+        # serve from cache if possible
+        entry = cache.read(cache.CONFERENCE, request.websafeConferenceKey,
+                           ConferenceForm)
+        if entry.form:
+            return entry.form
         # get Conference object from request; bail if not found
         conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
+        # report the live seat count from the seat shards
+        conf.seatsAvailable = seats.getSeatsAvailable(conf)
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        cf = self._copyConferenceToForm(conf)
+        entry.store(cf)
+        return cf
 
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @endpoints.method(CONF_LIST_REQUEST, ConferenceForms,
             path='getConferencesCreated',
             http_method='POST', name='getConferencesCreated')
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
         # make sure user is authed
-        user_id =  get_current_user_id()
+        user_id = self._getUserId()
         # create ancestor query for all key matches for this user
-        confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        confs, next_page = self._fetchPage(
+            Conference.query(ancestor=ndb.Key(Profile, user_id)), request)
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
+            items=[self._copyConferenceToForm(conf) for conf in confs],
+            nextPageToken=next_page
         )
 
 # - - - - - - - - - - Conference Query functions
     def ____CONF_QUERY_PART():
         pass # marked as a divider in function tree view
 
-    def _getConferenceQuery(self, request):
-        """Return formatted query from the submitted filters."""
-        q = Conference.query()
-        inequality_filter, filters = self._formatFilters(request.filters)
+    def _getConferenceQuery(self, filters, projection=None):
+        """Return formatted query and residual filters from the formatted
+        filters."""
+        return self._applyFilters(Conference.query(), Conference, filters,
+                                  projection)
+
+
+    def _applyFilters(self, q, model, filters, projection=None, scope=()):
+        """Apply filters to query q, returning (query, residual filters).
+
+        Equality filters and the inequality filters on the field the query
+        engine estimates as most selective run in the datastore; filters
+        on any further inequality field are returned as residual filters,
+        to be evaluated in Python. Plans are cached per canonical filter
+        list, and every run is recorded for the index advisor, together
+        with the ancestor of q and the scope fields q has equality
+        filters on already.
+        """
+        inequality_filter, filters, residual = queryengine.cachedPlan(
+            model, filters,
+            lambda fields: queryengine.getFieldStats(model, fields))
 
         # If exists, sort on inequality filter first
         if not inequality_filter:
-            q = q.order(Conference.name)
+            orders = ['name']
+            q = q.order(model.name)
         else:
+            orders = [inequality_filter, 'name']
             q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Conference.name)
+            q = q.order(model.name)
+        queryengine.recordPlan(
+            model._get_kind(), filters, inequality_filter, orders,
+            [prop._name for prop in projection] if projection else None,
+            ancestor=q.ancestor is not None, scope=scope)
 
         for filtr in filters:
-            if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
             formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
             q = q.filter(formatted_query)
-        return q
+        return q, residual
 
 
-    def _formatFilters(self, filters):
+    def _formatFilters(self, filters, fields=FIELDS_CONF):
         """Parse, check validity and format user supplied filters."""
         formatted_filters = []
-        inequality_field = None
 
         for f in filters:
             filtr = {field.name: getattr(f, field.name) for field in f.all_fields()}
 
             try:
-                filtr["field"] = FIELDS_CONF[filtr["field"]]
+                filtr["field"] = fields[filtr["field"]]
                 filtr["operator"] = OPERATORS[filtr["operator"]]
             except KeyError:
                 raise endpoints.BadRequestException("Filter contains invalid field or operator.")
 
-            # Every operation except "=" is an inequality
-            if filtr["operator"] != "=":
-                # check if inequality operation has been used in previous filters
-                # disallow the filter if inequality was performed on a different field before
-                # track the field on which the inequality operation is performed
-                if inequality_field and inequality_field != filtr["field"]:
-                    raise endpoints.BadRequestException("Inequality filter is allowed on only one field.")
-                else:
-                    inequality_field = filtr["field"]
+            # convert values of non-string fields
+            if filtr["field"] in FIELD_TYPES:
+                try:
+                    filtr["value"] = FIELD_TYPES[filtr["field"]](filtr["value"])
+                except (TypeError, ValueError):
+                    raise endpoints.BadRequestException(
+                        "Filter contains invalid value for %s." % filtr["field"])
 
             formatted_filters.append(filtr)
-        return (inequality_field, formatted_filters)
+        return formatted_filters
 
 
     @endpoints.method(QueryForms, ConferenceForms,
@@ -401,22 +630,51 @@ class ConferenceApi(remote.Service):
             name='queryConferences')
     def queryConferences(self, request):
         """Query for conferences."""
-        conferences = self._getConferenceQuery(request)
-
-        # 1. fetch organiser displayName from profiles
-        # get all keys and use get_multi
-        organisers = [(ndb.Key(Profile, conf.organizerUserId)) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        filters = self._formatFilters(request.filters)
+        # serialized result pages are cached per canonical filter list;
+        # conference writes bump the generation, which invalidates them
+        result_key = queryengine.resultKey(
+            'Conference', filters, request.pageSize, request.pageToken,
+            request.view == ListView.SUMMARY)
+        return protojson.decode_message(ConferenceForms,
+            queryengine.cachedResult('Conference', result_key,
+                lambda: protojson.encode_message(
+                    self._queryConferences(filters, request))))
+
+    def _queryConferences(self, filters, request):
+        """Run the conference query of formatted filters, returning the
+        requested page as ConferenceForms."""
+        # projection queries can't be merge-joined, and index.yaml only
+        # declares their indexes for a single filtered field; summaries
+        # of any other query are copied from full entities
+        projected = (len(set(f['field'] for f in filters)) <= 1 and
+                     sum(1 for f in filters if f['operator'] == '=') <= 1)
+        if request.view == ListView.SUMMARY and projected:
+            # projection query, served from the index only
+            projection = [Conference.name, Conference.startDate]
+            query, residual = self._getConferenceQuery(filters, projection)
+            conferences, next_page = self._fetchPage(
+                query, request, residual, projection=projection)
+            return ConferenceForms(
+                summaries=[self._copyConferenceToSummary(conf)
+                           for conf in conferences],
+                nextPageToken=next_page
+            )
 
-        # parse display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        query, residual = self._getConferenceQuery(filters)
+        conferences, next_page = self._fetchPage(query, request, residual)
+        if request.view == ListView.SUMMARY:
+            return ConferenceForms(
+                summaries=[self._copyConferenceToSummary(conf)
+                           for conf in conferences],
+                nextPageToken=next_page
+            )
 
-        # 2. return individual ConferenceForm object per Conference
+        # return individual ConferenceForm object per Conference;
+        # organizer displayName is denormalized on the Conference
         return ConferenceForms(
-                items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in \
-                conferences]
+                items=[self._copyConferenceToForm(conf) for conf in conferences],
+                nextPageToken=next_page
         )
 
 # - - - Speaker objects - - - - - - - - - - - - - - - - -
@@ -437,7 +695,7 @@ class ConferenceApi(remote.Service):
     def _createSpeakerObject(self, request):
         """Create Speaker object, returning SpeakerFormOut."""
         # preload necessary data items
-        user_id = get_current_user_id()
+        user_id = self._getUserId()
 
         if not request.name:
             raise endpoints.BadRequestException(
@@ -450,6 +708,7 @@ class ConferenceApi(remote.Service):
         # generate Profile Key based on user ID, used as parent
         p_key = ndb.Key(Profile, user_id)
         data['parent'] = p_key
+        self._storeNewProfile(self._getProfileFromUser())
 
         # create Speaker & return (new) SpeakerFormOut
         speaker = Speaker(**data).put()
@@ -457,7 +716,7 @@ class ConferenceApi(remote.Service):
 
     @ndb.transactional()
     def _updateSpeakerObject(self, request):
-        user_id = get_current_user_id()
+        user_id = self._getUserId()
 
         # update existing speaker
         speaker = ndb.Key(urlsafe=request.websafeSpeakerKey).get()
@@ -481,6 +740,7 @@ class ConferenceApi(remote.Service):
                 # write to Speaker object
                 setattr(speaker, field.name, data)
         speaker.put()
+        cache.invalidate(cache.SPEAKER, request.websafeSpeakerKey)
         return self._copySpeakerToForm(speaker)
 
     @endpoints.method(
@@ -496,7 +756,20 @@ class ConferenceApi(remote.Service):
             http_method='PUT', name='updateSpeaker')
     def updateSpeaker(self, request):
         """Update speaker with provided fields & return with updated info."""
-        return self._updateSpeakerObject(request)
+        sf = self._updateSpeakerObject(request)
+        # cached sessions embed the speaker name as well; queried outside
+        # of the transaction as it is not an ancestor query
+        sess_keys = Session.query(
+            Session.speaker == ndb.Key(urlsafe=request.websafeSpeakerKey)
+        ).fetch(keys_only=True)
+        cache.invalidate(cache.SESSION,
+                         *[sess_key.urlsafe() for sess_key in sess_keys])
+        # and so do the schedule snapshots and featured speaker
+        # announcements of their conferences
+        for conf_key in sessionkeys.conferencesOf(sess_keys):
+            schedule.scheduleRebuild(conf_key)
+            self._searchFeaturedSpeakers(conf_key)
+        return sf
 
     @endpoints.method(
             SPEAKER_GET_REQUEST, SpeakerFormOut,
@@ -504,6 +777,11 @@ class ConferenceApi(remote.Service):
             http_method='GET', name='getSpeaker')
     def getSpeaker(self, request):
         """Return requested speaker (by websafeSpeakerKey)."""
+        # serve from cache if possible
+        entry = cache.read(cache.SPEAKER, request.websafeSpeakerKey,
+                           SpeakerFormOut)
+        if entry.form:
+            return entry.form
         # get Speaker object from request; bail if not found
         speaker = ndb.Key(urlsafe=request.websafeSpeakerKey).get()
         if not speaker:
@@ -513,25 +791,91 @@ class ConferenceApi(remote.Service):
             raise endpoints.NotFoundException(
                 'Key does not belong to speaker: %s'% request.websafeSpeakerKey)
         # return SpeakerFormOut
-        return self._copySpeakerToForm(speaker)
+        sf = self._copySpeakerToForm(speaker)
+        entry.store(sf)
+        return sf
 
-    @endpoints.method(message_types.VoidMessage, SpeakerForms,
+    @endpoints.method(SPEAKER_LIST_REQUEST, SpeakerForms,
             path='getAllSpeakers',
             http_method='GET', name='getAllSpeakers')
     def getAllSpeakers(self, request):
-        """Get all Speakers"""
-        user_id = get_current_user_id()
-        speakers = Speaker.query()  # get all speakers
+        """Get all Speakers, or with mine only the user's, page by page"""
+        user_id = self._getUserId()
+        query = Speaker.query()
+        if request.mine:
+            # speakers are children of their organizer's Profile
+            query = Speaker.query(ancestor=ndb.Key(Profile, user_id))
+        # the summary view is served from the name index by a
+        # projection query
+        options = {}
+        if request.view == ListView.SUMMARY:
+            options['projection'] = [Speaker.name]
+        # never return all speakers at once
+        request.pageSize = request.pageSize or DEFAULT_PAGE_SIZE
+        speakers, next_page = self._fetchPage(query, request, **options)
         return SpeakerForms(
-            items=[self._copySpeakerToForm(speaker) for speaker in speakers]
+            items=[self._copySpeakerToForm(speaker) for speaker in speakers],
+            nextPageToken=next_page
         )
 
+    @endpoints.method(SPEAKER_SEARCH_REQUEST, SpeakerForms,
+            path='speakers/search',
+            http_method='GET', name='searchSpeakers')
+    def searchSpeakers(self, request):
+        """Return speakers whose name or one of its words starts with
+        prefix, from the nameTokens index by a projection query"""
+        prefix = textutil.normalize(request.prefix)
+        if not prefix:
+            raise endpoints.BadRequestException("'prefix' field required")
+        limit = min(request.limit or DEFAULT_SEARCH_LIMIT, MAX_SEARCH_LIMIT)
+        if limit <= 0:
+            raise endpoints.BadRequestException("limit must be positive")
+
+        query = Speaker.query()
+        if request.mine:
+            query = Speaker.query(ancestor=ndb.Key(Profile, self._getUserId()))
+        query = query.filter(Speaker.nameTokens >= prefix,
+                             Speaker.nameTokens < prefix + u'\ufffd')
+        # a speaker matching several tokens is returned once per token
+        speakers = []
+        seen = set()
+        for speaker in query.order(Speaker.nameTokens).iter(
+                projection=[Speaker.name], batch_size=limit):
+            if speaker.key not in seen:
+                seen.add(speaker.key)
+                speakers.append(speaker)
+                if len(speakers) >= limit:
+                    break
+        return SpeakerForms(
+            items=[self._copySpeakerToForm(speaker) for speaker in speakers])
+
+    @staticmethod
+    def _reindexSpeakers(websafeCursor=None):
+        """Store existing speakers again to fill their nameTokens batch by
+        batch; used by main.ReindexSpeakersHandler, which is re-enqueued
+        with the returned cursor until all speakers are done.
+        """
+        cursor = Cursor(urlsafe=websafeCursor) if websafeCursor else None
+        speakers, next_cursor, more = Speaker.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor)
+        ndb.put_multi(speakers)
+        logging.info("_reindexSpeakers: %d speakers reindexed"
+            % len(speakers))
+        if more and next_cursor:
+            return next_cursor.urlsafe()
+
 # - - - Session objects - - - - - - - - - - - - - - - - -
     def ____SESS_PART():
         pass # marked as a divider in function tree view
 
-    def _copySessionToForm(self, sess):
-        """Copy relevant fields from Session to SessionFormOut."""
+    def _copySessionToForm(self, sess, speakers=None):
+        """Copy relevant fields from Session to SessionFormOut.
+
+        speakers is an optional dict of speaker key -> Speaker entity;
+        if not given, the speakers of this session are fetched at once.
+        """
+        if speakers is None:
+            speakers = self._getSpeakersOfSessions([sess])
         sf = SessionFormOut()
         for field in sf.all_fields():
             if hasattr(sess, field.name):
@@ -541,72 +885,98 @@ class ConferenceApi(remote.Service):
                 if field.name in ("startTime", "date"):
                     setattr(sf, field.name, str(getattr(sess, field.name)))
                 elif field.name == "speaker":
-                    speakers = []
-                    for speaker_key in getattr(sess, "speaker"):
-                        speaker = speaker_key.get()
-                        speakers.append(self._copySpeakerToForm(speaker))
-                    setattr(sf, "speaker", speakers)
+                    setattr(sf, "speaker", [
+                        self._copySpeakerToForm(speakers[speaker_key])
+                        for speaker_key in getattr(sess, "speaker")
+                        if speakers.get(speaker_key)])
                 else:
                     setattr(sf, field.name, getattr(sess, field.name))
             elif field.name == "sessionId":
                 setattr(sf, field.name, str(sess.key.id()))
             elif field.name == "websafeConferenceKey":
-                setattr(sf, field.name, sess.key.parent().urlsafe())
+                setattr(sf, field.name,
+                        sessionkeys.conferenceOf(sess).urlsafe())
         sf.check_initialized()
         return sf
 
-    def _createSessionObject(self, request):
-        """
-        Create Session object, returning SessionFormOut.
+    @ndb.tasklet
+    def _getSpeakersOfSessionsAsync(self, sessions):
+        """Tasklet version of _getSpeakersOfSessions()."""
+        speaker_keys = list(set(
+            speaker_key
+            for sess in sessions if sess
+            for speaker_key in sess.speaker))
+        speakers = yield ndb.get_multi_async(speaker_keys)
+        raise ndb.Return(dict(zip(speaker_keys, speakers)))
+
+    def _getSpeakersOfSessions(self, sessions):
+        """Return dict of speaker key -> Speaker for all given sessions.
+
+        Speaker keys are collected across the whole result set and
+        deduplicated, so only one get_multi() is needed.
         """
-        # preload necessary data items
-        user_id = get_current_user_id()
+        with rpcstats.phase('speakers'):
+            return self._getSpeakersOfSessionsAsync(sessions).get_result()
+
+    def _copySessionsToForms(self, sessions, next_page=None, speakers=None):
+        """Copy Sessions to SessionForms, resolving speakers in one batch."""
+        sessions = [sess for sess in sessions if sess]
+        if speakers is None:
+            speakers = self._getSpeakersOfSessions(sessions)
+        return SessionForms(
+            items=[self._copySessionToForm(sess, speakers)
+                   for sess in sessions],
+            nextPageToken=next_page
+        )
 
-        # load conference
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey)
-        if conf.kind() != "Conference":
-            raise endpoints.BadRequestException(
-                "Conference key expected")
+    def _copySessionToSummary(self, sess, conf=None):
+        """Copy projected fields from Session to SessionSummaryForm.
 
-        # check if the conference has the right owner
-        if conf.get().organizerUserId != user_id:
-            raise endpoints.BadRequestException(
-                "Only the conference owner can add sessions")
-
-        if not request.name:
+        conf is the conference key, needed for sessions of the flat key
+        layout that were projected without their conferenceKey.
+        """
+        return SessionSummaryForm(
+            name=sess.name,
+            date=str(sess.date) if sess.date else None,
+            startTime=str(sess.startTime) if sess.startTime else None,
+            websafeConferenceKey=(
+                conf or sessionkeys.conferenceOf(sess)).urlsafe(),
+            sessionId=str(sess.key.id()))
+
+    def _sessionDataFromForm(self, form):
+        """Copy SessionFormIn into a dict of Session properties.
+
+        Speaker keys are parsed and checked for their kind, but not
+        looked up; that is left to the caller, for all sessions at once.
+        """
+        if not form.name:
             raise endpoints.BadRequestException(
                 "Session 'name' field required")
 
         # copy SessionFormIn/ProtoRPC Message into dict
-        data = {field.name: getattr(request, field.name)
-                for field in request.all_fields()}
+        data = {field.name: getattr(form, field.name)
+                for field in SessionFormIn.all_fields()}
         # The speaker field will be dealt with specially
         del data['speaker_key']
-        # delete websafeConferenceKey
-        del data['websafeConferenceKey']
         # we have to adjust the typeOfSession
         if data['typeOfSession']:
             data['typeOfSession'] = (
-                str(getattr(request, 'typeOfSession')))
+                str(getattr(form, 'typeOfSession')))
 
         # add default values for those missing
         # (both data model & outbound Message)
         for df in DEFAULTS_SESS:
             if data[df] in (None, []):
                 data[df] = DEFAULTS_SESS[df]
-                setattr(request, df, DEFAULTS_SESS[df])
+                setattr(form, df, DEFAULTS_SESS[df])
 
         # add speakers
         speaker_keys = []
-        for speakerform in getattr(request, 'speaker_key'):
+        for speakerform in getattr(form, 'speaker_key'):
             speaker_key = ndb.Key(urlsafe=speakerform)
             if speaker_key.kind() != "Speaker":
                 raise endpoints.BadRequestException(
                     "Speaker key expected")
-                # we try to get the data - is the speaker existing?
-            speaker = speaker_key.get()
-            if speaker is None:
-                raise endpoints.BadRequestException("Speaker not found")
             speaker_keys.append(speaker_key)
         data['speaker'] = speaker_keys
 
@@ -618,33 +988,89 @@ class ConferenceApi(remote.Service):
         if data['startTime']:
             data['startTime'] = datetime.strptime(data['startTime'][:5],
                                                   "%H:%M").time()
+        return data
 
-        # set session parent to conference
-        data['parent'] = conf
-
-        # create Session, search for featured speaker in a task
-        session = Session(**data).put()
-        taskqueue.add(
-            params=
-                {
-                    'sessionId': str(session.id()),
-                    'websafeConferenceKey': session.parent().urlsafe()
-                },
-            url='/tasks/search_featured_speakers'
-            )
+    def _createSessionObjects(self, websafeConferenceKey, forms):
+        """
+        Create Session objects in one batch, returning SessionForms.
 
-        return self._copySessionToForm(session.get())
+        All speakers are validated with one get_multi(), ids allocated
+        with one allocate_ids() and sessions written with one put_multi();
+        the response is built from the written entities.
+        """
+        # preload necessary data items
+        user_id = self._getUserId()
 
-    @ndb.transactional()
+        # load conference
+        conf = ndb.Key(urlsafe=websafeConferenceKey)
+        if conf.kind() != "Conference":
+            raise endpoints.BadRequestException(
+                "Conference key expected")
+        conference = conf.get()
+        if not conference:
+            raise endpoints.NotFoundException('Conference not found')
+
+        # check if the conference has the right owner
+        if conference.organizerUserId != user_id:
+            raise endpoints.BadRequestException(
+                "Only the conference owner can add sessions")
+
+        if not forms:
+            raise endpoints.BadRequestException("No sessions given")
+        if len(forms) > MAX_SESSIONS_BATCH:
+            raise endpoints.BadRequestException(
+                "At most %d sessions can be created at once"
+                % MAX_SESSIONS_BATCH)
+        datas = [self._sessionDataFromForm(form) for form in forms]
+
+        # we try to get the data - are the speakers existing?
+        speaker_keys = list(set(
+            speaker_key for data in datas for speaker_key in data['speaker']))
+        speakers = dict(zip(speaker_keys, ndb.get_multi(speaker_keys)))
+        if not all(speakers.values()):
+            raise endpoints.BadRequestException("Speaker not found")
+
+        # keys in the configured layout, with ids allocated at once
+        sessions = [Session(key=sess_key, conferenceKey=conf, **data)
+                    for sess_key, data in zip(
+                        sessionkeys.allocateKeys(conf, len(datas)), datas)]
+
+        # create Sessions, search for featured speakers in one task
+        ndb.put_multi(sessions)
+        schedule.scheduleRebuild(conf, [sess.key for sess in sessions])
+        search.enqueue([sess.key for sess in sessions])
+        self._searchFeaturedSpeakers(
+            conf, [sess.key.id() for sess in sessions])
+
+        return self._copySessionsToForms(sessions, speakers=speakers)
+
+    def _createSessionObject(self, request):
+        """
+        Create Session object, returning SessionFormOut.
+        """
+        return self._createSessionObjects(
+            request.websafeConferenceKey, [request]).items[0]
+
+    @ndb.non_transactional
+    def _getSpeakersByKeys(self, speaker_keys):
+        """Return dict of speaker key -> Speaker, read outside of any
+        transaction as speakers live in other entity groups."""
+        return dict(zip(speaker_keys, ndb.get_multi(speaker_keys)))
+
+    @ndb.transactional(xg=True)
     def _updateSessionObject(self, request):
-        """Update the session object."""
-        user_id = get_current_user_id()
+        """Update the session object; returns its key and SessionFormOut."""
+        user_id = self._getUserId()
 
         # get the conference object
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        if conf.kind() != 'Conference':
+        conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        if conf_key.kind() != 'Conference':
             raise endpoints.BadRequestException(
                 'Provided conference key is invalid')
+        conf = conf_key.get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
 
         # check that user is organizer
         if user_id != conf.organizerUserId:
@@ -652,7 +1078,7 @@ class ConferenceApi(remote.Service):
                 'Only the owner can update the conference.')
 
         # get the existing session
-        sess = Session.get_by_id(int(request.sessionId), parent=conf)
+        sess = sessionkeys.get(conf_key, request.sessionId)
         # check that session exists
         if not sess:
             raise endpoints.NotFoundException(
@@ -660,34 +1086,39 @@ class ConferenceApi(remote.Service):
 
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from SessionFormIn to Session object
-        for field in request.all_fields():
-            data = getattr(request, field.name)
+        for field in SessionFormIn.all_fields():
+            name = field.name
+            data = getattr(request, name)
             # only copy fields where we get data
             if data not in (None, []):
                 # special handling for dates (convert string to Date)
-                if field.name in ('date', 'startTime'):
-                    data = datetime.strptime(data, "%Y-%m-%d").date()
+                if name == 'date':
+                    data = datetime.strptime(data[:10], "%Y-%m-%d").date()
+                # special handling for times (convert string to Time)
+                elif name == 'startTime':
+                    data = datetime.strptime(data[:5], "%H:%M").time()
                 # special handling for speaker: convert to key
-                if field.name == 'speaker':
-                    data2 = []
+                elif name == 'speaker_key':
+                    speaker_keys = []
                     for speakerform in data:
-                        speaker_key = ndb.Key(urlsafe=speakerform.websafeKey)
+                        speaker_key = ndb.Key(urlsafe=speakerform)
                         if speaker_key.kind() != 'Speaker':
                             raise endpoints.BadRequestException('Expected Speaker key')
-                        # check if the speaker exists
-                        if speaker_key.get() is None:
-                            raise endpoints.BadRequestException('Could not find speaker')
-                        # set speaker key
-                        data2.append(speaker_key)
-                    # replace speaker forms with speaker key list
-                    data = data2
+                        speaker_keys.append(speaker_key)
+                    # check if the speakers exist
+                    if not all(self._getSpeakersByKeys(speaker_keys).values()):
+                        raise endpoints.BadRequestException('Could not find speaker')
+                    # replace speaker key strings with speaker key list
+                    name, data = 'speaker', speaker_keys
                 # special handling for session type
-                if field.name == 'typeOfSession':
-                    data = getattr(SessionType, data)
-                # write to Conference object
-                setattr(conf, field.name, data)
+                elif name == 'typeOfSession':
+                    data = str(data)
+                # write to Session object
+                setattr(sess, name, data)
         sess.put()
-        return self._copySessionToForm(sess)
+        cache.invalidate(cache.SESSION, sess.key.urlsafe())
+        return sess.key, self._copySessionToForm(
+            sess, self._getSpeakersByKeys(sess.speaker))
 
     @endpoints.method(
         SESS_CREATE_REQUEST, SessionFormOut,
@@ -697,13 +1128,30 @@ class ConferenceApi(remote.Service):
         """Create new session in a conference."""
         return self._createSessionObject(request)
 
+    @endpoints.method(
+        SESS_BATCH_REQUEST, SessionForms,
+        path='conference/{websafeConferenceKey}/sessions',
+        http_method='POST', name='createSessionsBatch')
+    def createSessionsBatch(self, request):
+        """Create many sessions in a conference at once."""
+        return self._createSessionObjects(
+            request.websafeConferenceKey, request.items)
+
     @endpoints.method(
         SESS_POST_REQUEST, SessionFormOut,
         path='conference/{websafeConferenceKey}/session/{sessionId}',
         http_method='PUT', name='updateSession')
     def updateSession(self, request):
         """Update session with provided fields & return with updated info."""
-        return self._updateSessionObject(request)
+        sess_key, sf = self._updateSessionObject(request)
+        conf = ndb.Key(urlsafe=request.websafeConferenceKey)
+        schedule.scheduleRebuild(conf)
+        # ids handed out before a move resolve to another key, so use the
+        # one of the session actually updated
+        search.enqueue([sess_key])
+        # speakers of the session may have changed
+        self._searchFeaturedSpeakers(conf, [sess_key.id()])
+        return sf
 
     @endpoints.method(
         SESS_GET_REQUEST, SessionFormOut,
@@ -717,46 +1165,142 @@ class ConferenceApi(remote.Service):
         if conf.kind() != 'Conference':
             raise endpoints.BadRequestException(
                 'Provided conference key is invalid')
+        # serve from cache if possible
+        wssk = sessionkeys.sessionKey(conf, request.sessionId).urlsafe()
+        entry = cache.read(cache.SESSION, wssk, SessionFormOut)
+        # flat session keys don't name their conference, so check it
+        if entry.form and entry.form.websafeConferenceKey == conf.urlsafe():
+            return entry.form
         # get Session object from request; bail if not found
         # dumpclean(request)
-        sess = Session.get_by_id(int(request.sessionId), parent=conf)
+        sess = sessionkeys.get(conf, request.sessionId)
         if not sess:
             raise endpoints.NotFoundException(
                 'No session found with id %s' % request.sessionId)
-        # return SessionFormOut
-        return self._copySessionToForm(sess)
+        # return SessionFormOut; sessions found under a key of the other
+        # layout are not cached, as updates invalidate their own key
+        sf = self._copySessionToForm(sess)
+        if sess.key.urlsafe() == wssk:
+            entry.store(sf)
+        return sf
+
+    @staticmethod
+    def _migrateSessionKeys(websafeCursor=None):
+        """Move the sessions of a batch of conferences into the configured
+        key layout; used by main.MigrateSessionKeysHandler, which is
+        re-enqueued with the returned cursor until all conferences are
+        done, and then moves the wishlist entries.
+        """
+        cursor = Cursor(urlsafe=websafeCursor) if websafeCursor else None
+        conf_keys, next_cursor, more = Conference.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        count = 0
+        for conf_key in conf_keys:
+            moved = sessionkeys.migrate(conf_key)
+            if not moved:
+                continue
+            count += len(moved)
+            old_keys = [old_key for old_key, _ in moved]
+            new_keys = [new_key for _, new_key in moved]
+            # everything keyed by the old session keys or ids follows
+            cache.invalidate(cache.SESSION,
+                             *[old_key.urlsafe() for old_key in old_keys])
+            schedule.scheduleRebuild(conf_key, new_keys)
+            search.enqueue(old_keys + new_keys)
+            featured.enqueue(conf_key, [sess_key.id()
+                                        for sess_key in old_keys + new_keys])
+        logging.info("_migrateSessionKeys: %d sessions of %d conferences "
+            "moved to the %s layout"
+            % (count, len(conf_keys), sessionkeys.getLayout()))
+        if more and next_cursor:
+            return next_cursor.urlsafe()
+
+# - - - - - - - - - Session Schedule Snapshot
+    def ____SCHEDULE_PART():
+        pass # marked as a divider in function tree view
+
+    def _buildSchedule(self, conf, sess_keys=()):
+        """Build and store the schedule snapshot of a conference; sess_keys
+        are sessions just written, which a query may miss yet."""
+        sessions = sessionkeys.fetchAll(conf, sess_keys)
+        return schedule.store(conf, self._copySessionsToForms(sessions))
+
+    def _getSchedule(self, conf):
+        """Return the time-sorted SessionFormOuts of a conference from its
+        schedule snapshot, building the snapshot if there is none yet."""
+        forms = schedule.load(conf)
+        if forms is None:
+            # is the conference existing?
+            if conf.get() is None:
+                raise endpoints.NotFoundException('Conference not found')
+            forms = self._buildSchedule(conf)
+        return forms.items
+
+    @staticmethod
+    def _rebuildSchedule(websafeConferenceKey):
+        """Rebuild the schedule snapshot of a conference; used by
+        main.RebuildScheduleHandler
+        """
+        conf = ndb.Key(urlsafe=websafeConferenceKey)
+        if conf.kind() != 'Conference':
+            logging.error("_rebuildSchedule: provided conference key %s invalid"
+                % websafeConferenceKey)
+            return
+        return schedule.rebuild(conf, ConferenceApi()._buildSchedule)
+
+    def _copyTimetableToForm(self, table, summaries):
+        """Return the ScheduleForm of a Timetable; summaries holds the
+        SessionSummaryForm of each session the table was built from."""
+        pairs, count = table.conflicts(MAX_CONFLICTS)
+        return ScheduleForm(
+            schedule=[summaries[i] for i in table.schedule()],
+            conflicts=[SessionConflictForm(first=summaries[i],
+                                           second=summaries[j])
+                       for i, j in pairs],
+            conflictCount=count,
+            untimed=[summaries[i] for i in table.untimed])
+
+    @endpoints.method(CONF_GET_REQUEST, ScheduleForm,
+        path='conference/{websafeConferenceKey}/schedule',
+        http_method='GET', name='getConferenceSchedule')
+    def getConferenceSchedule(self, request):
+        """Return overlapping sessions of a conference and a largest
+        conflict-free schedule of them."""
+        # get the conference
+        conf = ndb.Key(urlsafe=request.websafeConferenceKey)
+        # is it really a conference key?
+        if conf.kind() != 'Conference':
+            raise endpoints.BadRequestException(
+                'Provided key is not a conference key')
+        forms = self._getSchedule(conf)
+        summaries = [SessionSummaryForm(
+                         name=sf.name,
+                         date=sf.date if sf.date != 'None' else None,
+                         startTime=(sf.startTime
+                                    if sf.startTime != 'None' else None),
+                         durationInMins=sf.durationInMins,
+                         websafeConferenceKey=sf.websafeConferenceKey,
+                         sessionId=sf.sessionId)
+                     for sf in forms]
+        return self._copyTimetableToForm(timetable.fromForms(forms),
+                                         summaries)
 
 # - - - - - - - - - Session Query Methods
     def ____SESS_QUERY_PART():
         pass # marked as a divider in function tree view
 
     def _getSessionQuery(self, request):
-        """Return formatted query from the submitted filters."""
+        """Return formatted query and residual filters from the submitted
+        filters."""
         # check for the provided conference
         conf = ndb.Key(urlsafe=request.websafeConferenceKey)
         if conf.kind() != 'Conference':
             raise endpoints.BadRequestException(
                 'Conference specified not valid')
-        q = Session.query(ancestor=conf)
-        inequality_filter, filters = self._formatFilters(
-            request.filters, FIELDS_SESS)
-
-        # If exists, sort on inequality filter first
-        if not inequality_filter:
-            q = q.order(Session.name)
-        else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Session.name)
-
-        for filtr in filters:
-            if filtr["field"] == "durationInMins":
-                filtr["value"] = int(filtr["value"])
-            formatted_query = ndb.query.FilterNode(
-                filtr["field"],
-                filtr["operator"],
-                filtr["value"])
-            q = q.filter(formatted_query)
-        return q
+        return self._applyFilters(
+            sessionkeys.query(conf), Session,
+            self._formatFilters(request.filters, FIELDS_SESS),
+            scope=sessionkeys.scopeFields())
 
     @endpoints.method(
             SESS_QUERY_FORMS, SessionForms,
@@ -765,16 +1309,14 @@ class ConferenceApi(remote.Service):
             name='querySessions')
     def querySessions(self, request):
         """Query for sessions."""
-        sessions = self._getSessionQuery(request)
+        query, residual = self._getSessionQuery(request)
+        sessions, next_page = self._fetchPage(query, request, residual)
 
         # return individual SessionFormOut object per Session
-        return SessionForms(
-                items=[self._copySessionToForm(sess)
-                       for sess in sessions]
-        )
+        return self._copySessionsToForms(sessions, next_page)
 
     @endpoints.method(
-        CONF_GET_REQUEST, SessionForms,
+        SESS_LIST_REQUEST, SessionForms,
         path='conference/{websafeConferenceKey}/session',
         http_method='GET',
         name='getConferenceSessions')
@@ -786,16 +1328,24 @@ class ConferenceApi(remote.Service):
         if conf.kind() != 'Conference':
             raise endpoints.BadRequestException(
                 'Provided key is not a conference key')
-        # is the conference existing?
-        if conf.get() is None:
-            raise endpoints.NotFoundException('Conference not found')
-        # get all sessions in the conference
-        sessions = Session.query(ancestor=conf)
-        # return individual SessionFormOut object per Session
-        return SessionForms(
-                items=[self._copySessionToForm(sess)
-                       for sess in sessions]
-        )
+        if request.view == ListView.SUMMARY:
+            # is the conference existing?
+            if conf.get() is None:
+                raise endpoints.NotFoundException('Conference not found')
+            # projection query in schedule order, no speakers resolved
+            sessions, next_page = self._fetchPage(
+                sessionkeys.query(conf).order(
+                    Session.date, Session.startTime, Session.name),
+                request,
+                projection=[Session.date, Session.startTime, Session.name])
+            return SessionForms(
+                summaries=[self._copySessionToSummary(sess, conf)
+                           for sess in sessions],
+                nextPageToken=next_page
+            )
+        # get all sessions in the conference from the schedule snapshot
+        items, next_page = self._pageItems(self._getSchedule(conf), request)
+        return SessionForms(items=items, nextPageToken=next_page)
 
     @endpoints.method(
         SESS_GET_BY_TYPE, SessionForms,
@@ -810,18 +1360,12 @@ class ConferenceApi(remote.Service):
         if conf.kind() != 'Conference':
             raise endpoints.BadRequestException(
                 'Provided key is not a conference key')
-        # is the conference existing?
-        if conf.get() is None:
-            raise endpoints.NotFoundException('Conference not found')
-        # get all sessions in the conference
-        sessions = Session.query(ancestor=conf)
-        # and filter by session type
-        sessions = sessions.filter(Session.typeOfSession == request.typeOfSession)
-        # return individual SessionFormOut object per Session
-        return SessionForms(
-                items=[self._copySessionToForm(sess)
-                       for sess in sessions]
-        )
+        # get all sessions in the conference from the schedule snapshot
+        # and filter by session type in memory
+        items = [sf for sf in self._getSchedule(conf)
+                 if sf.typeOfSession == request.typeOfSession]
+        items, next_page = self._pageItems(items, request)
+        return SessionForms(items=items, nextPageToken=next_page)
 
     @endpoints.method(
         SESS_GET_ALL_BY_SPEAKER, SessionForms,
@@ -840,12 +1384,10 @@ class ConferenceApi(remote.Service):
         if speaker.get() is None:
             raise endpoints.NotFoundException('Speaker not found')
         # get all sessions with this speaker
-        sessions = Session.query(Session.speaker == speaker)
+        sessions, next_page = self._fetchPage(
+            Session.query(Session.speaker == speaker), request)
         # return individual SessionFormOut object per Session
-        return SessionForms(
-                items=[self._copySessionToForm(sess)
-                       for sess in sessions]
-        )
+        return self._copySessionsToForms(sessions, next_page)
 
     def ____TWO_ADDITIONAL_QUERY():
         pass # marked as a divider in function tree view
@@ -863,18 +1405,12 @@ class ConferenceApi(remote.Service):
         if conf.kind() != 'Conference':
             raise endpoints.BadRequestException(
                 'Provided key is not a conference key')
-        # is the conference existing?
-        if conf.get() is None:
-            raise endpoints.NotFoundException('Conference not found')
-        # get all sessions in the conference
-        sessions = Session.query(ancestor=conf)
-        # and filter by highlight
-        sessions = sessions.filter(Session.highlight == request.highlight)
-        # return individual SessionFormOut object per Session
-        return SessionForms(
-                items=[self._copySessionToForm(sess)
-                       for sess in sessions]
-        )
+        # get all sessions in the conference from the schedule snapshot
+        # and filter by highlight in memory
+        items = [sf for sf in self._getSchedule(conf)
+                 if request.highlight in sf.highlight]
+        items, next_page = self._pageItems(items, request)
+        return SessionForms(items=items, nextPageToken=next_page)
 
     @endpoints.method(
         SESS_GET_BY_LOCATION, SessionForms,
@@ -889,18 +1425,12 @@ class ConferenceApi(remote.Service):
         if conf.kind() != 'Conference':
             raise endpoints.BadRequestException(
                 'Provided key is not a conference key')
-        # is the conference existing?
-        if conf.get() is None:
-            raise endpoints.NotFoundException('Conference not found')
-        # get all sessions in the conference
-        sessions = Session.query(ancestor=conf)
-        # and filter by highlight
-        sessions = sessions.filter(Session.location == request.location)
-        # return individual SessionFormOut object per Session
-        return SessionForms(
-                items=[self._copySessionToForm(sess)
-                       for sess in sessions]
-        )
+        # get all sessions in the conference from the schedule snapshot
+        # and filter by location in memory
+        items = [sf for sf in self._getSchedule(conf)
+                 if sf.location == request.location]
+        items, next_page = self._pageItems(items, request)
+        return SessionForms(items=items, nextPageToken=next_page)
 
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
     def ____PROFILE_PART():
@@ -915,33 +1445,81 @@ class ConferenceApi(remote.Service):
                 # convert t-shirt string to Enum; just copy others
                 if field.name == 'teeShirtSize':
                     setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
+                elif field.name in ('conferenceKeysToAttend',
+                                    'sessionKeysOnWishlist'):
+                    continue
                 else:
                     setattr(pf, field.name, getattr(prof, field.name))
+        # list entries are child entities; profiles not migrated yet
+        # still hold theirs in the legacy list properties. The lists are
+        # complete, as the client checks attendance against them
+        entries = [(model, userlists.query(model, prof.key).fetch_async(
+                       keys_only=True))
+                   for model in (Attendance, WishlistEntry)]
+        for model, future in entries:
+            field = userlists.LEGACY_FIELDS[model]
+            setattr(pf, field, sorted(
+                set(key.string_id() for key in future.get_result()) |
+                set(getattr(prof, field))))
         pf.check_initialized()
         return pf
 
 
+    # Endpoints creates a new service instance for every request, so
+    # the user and Profile memoized on self are request-scoped.
+
+    def _getUser(self):
+        """Return the current user, resolved once per request."""
+        if getattr(self, '_user', None) is None:
+            with rpcstats.phase('auth'):
+                # make sure user is authed
+                user = endpoints.get_current_user()
+                if not user:
+                    raise endpoints.UnauthorizedException(
+                        'Authorization required')
+                self._user = user
+                self._userId = getUserId(user)
+        return self._user
+
+    def _getUserId(self):
+        """Return the current user id, resolved once per request."""
+        self._getUser()
+        return self._userId
+
     def _getProfileFromUser(self):
-        """Return user Profile from datastore, creating new one if non-existent."""
-        # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
+        """Return user Profile, fetched from datastore once per request.
 
-        # get Profile from datastore
-        user_id = getUserId(user)
-        p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
-        # create new Profile if not there
-        if not profile:
-            profile = Profile(
-                key = p_key,
-                displayName = user.nickname(),
-                mainEmail= user.email(),
-            )
-            profile.put()
+        A missing Profile is returned as a new, unsaved entity; it is
+        stored by saveProfile() or _storeNewProfile() on the first write,
+        so reads never write. Inside a transaction the Profile is always
+        read again.
+        """
+        if getattr(self, '_profile', None) is None or ndb.in_transaction():
+            user = self._getUser()
+            p_key = ndb.Key(Profile, self._getUserId())
+            profile = p_key.get()
+            self._profileStored = profile is not None
+            if not profile:
+                profile = Profile(
+                    key = p_key,
+                    displayName = user.nickname(),
+                    mainEmail= user.email(),
+                )
+            self._profile = profile
+        return self._profile      # return Profile
+
+    def _storeNewProfile(self, prof):
+        """Store the default Profile of a new user, before the first entity
+        (conference, speaker or list entry) is written under it."""
+        if not getattr(self, '_profileStored', True):
+            prof.put()
+            self._profileStored = True
 
-        return profile      # return Profile
+    def _migrateUserLists(self, prof):
+        """Move legacy list entries of prof to child entities, once."""
+        if userlists.hasLegacyEntries(prof):
+            userlists.migrate(prof.key)
+            self._profile = None
 
 
     def _doProfile(self, save_request=None):
@@ -951,6 +1529,7 @@ class ConferenceApi(remote.Service):
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
+            displayName = prof.displayName
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
                     val = getattr(save_request, field)
@@ -961,6 +1540,11 @@ class ConferenceApi(remote.Service):
                         #else:
                         #    setattr(prof, field, val)
             prof.put()
+            # update the denormalized name on the user's conferences
+            if prof.displayName != displayName:
+                taskqueue.add(params={'userId': prof.key.id()},
+                    url='/tasks/update_organizer_name'
+                )
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
@@ -987,6 +1571,7 @@ class ConferenceApi(remote.Service):
         """Register or unregister user for selected conference."""
         retval = None
         prof = self._getProfileFromUser() # get user Profile
+        self._migrateUserLists(prof)
 
         # check if conf exists given websafeConfKey
         # get conference; check that it exists
@@ -999,59 +1584,68 @@ class ConferenceApi(remote.Service):
         # register
         if reg:
             # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
+            if userlists.contains(Attendance, prof.key, wsck):
                 raise ConflictException(
                     "You have already registered for this conference")
 
-            # check if seats avail
-            if conf.seatsAvailable <= 0:
+            # take away one seat from a seat shard, if seats avail
+            if not seats.reserveSeat(conf):
                 raise ConflictException(
                     "There are no seats available.")
 
-            # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
-            conf.seatsAvailable -= 1
+            # register user
+            self._storeNewProfile(prof)
+            userlists.add(Attendance, prof.key, wsck)
             retval = True
 
         # unregister
         else:
             # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
+            if userlists.contains(Attendance, prof.key, wsck):
 
                 # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
-                conf.seatsAvailable += 1
+                userlists.remove(Attendance, prof.key, wsck)
+                seats.releaseSeat(conf)
                 retval = True
             else:
                 retval = False
 
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
+        # only the attendance entry was written; the Conference entity
+        # itself is updated later by the seat reconciler
+        if retval:
+            cache.invalidate(cache.CONFERENCE, wsck)
         return BooleanMessage(data=retval)
 
+    def _reportSeatsChanged(self, conf_key):
+        """Report the seat count of a conference after a committed
+        registration; failures are only logged, as the registration
+        went through anyway."""
+        try:
+            conf = conf_key.get()
+            if conf:
+                announcements.seatsChanged(conf)
+        except Exception:
+            logging.exception("_reportSeatsChanged: %s failed"
+                % conf_key.urlsafe())
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+
+    @endpoints.method(CONF_LIST_REQUEST, ConferenceForms,
             path='conferences/attending',
             http_method='GET', name='getConferencesToAttend')
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
         prof = self._getProfileFromUser() # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
-
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        self._migrateUserLists(prof)
+        entry_keys, next_page = self._fetchPage(
+            userlists.query(Attendance, prof.key), request, keys_only=True)
+        # organizer displayName is denormalized on the Conference,
+        # so no organizer Profile has to be fetched
+        conferences = ndb.get_multi(userlists.toKeys(entry_keys))
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])\
-         for conf in conferences]
+        return ConferenceForms(items=[self._copyConferenceToForm(conf)\
+         for conf in conferences if conf],
+            nextPageToken=next_page
         )
 
 
@@ -1060,7 +1654,11 @@ class ConferenceApi(remote.Service):
             http_method='POST', name='registerForConference')
     def registerForConference(self, request):
         """Register user for selected conference."""
-        return self._conferenceRegistration(request)
+        retval = self._conferenceRegistration(request)
+        conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        seats.scheduleReconcile(conf_key)
+        self._reportSeatsChanged(conf_key)
+        return retval
 
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
@@ -1068,25 +1666,31 @@ class ConferenceApi(remote.Service):
             http_method='DELETE', name='unregisterFromConference')
     def unregisterFromConference(self, request):
         """Unregister user for selected conference."""
-        return self._conferenceRegistration(request, reg=False)
+        retval = self._conferenceRegistration(request, reg=False)
+        if retval.data:
+            conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+            seats.scheduleReconcile(conf_key)
+            self._reportSeatsChanged(conf_key)
+        return retval
 
 
 # - - - Wishlist - - - - - - - - - - - - - - - - - - - -
     def ____WISH_LIST_PART():
         pass # marked as a divider in function tree view
 
-    @ndb.transactional()
+    @ndb.transactional(xg=True)
     def _sessionWishlist(self, request, reg=True):
         """Add a session to the wishlist."""
         retval = None
         prof = self._getProfileFromUser()  # get user Profile
+        self._migrateUserLists(prof)
         # get the conference key
         conf = ndb.Key(urlsafe=request.websafeConferenceKey)
         if conf.kind() != 'Conference':
             raise endpoints.BadRequestException(
                 'Provided conference key is invalid')
         # check if session exists given sessionId
-        session = Session.get_by_id(int(request.sessionId), parent=conf)
+        session = sessionkeys.get(conf, request.sessionId)
         # get session; check that it exists
         if not session:
             raise endpoints.NotFoundException(
@@ -1097,45 +1701,73 @@ class ConferenceApi(remote.Service):
         # add to wishlist
         if reg:
             # check if user already has session otherwise add
-            if wssk in prof.sessionKeysOnWishlist:
+            if userlists.contains(WishlistEntry, prof.key, wssk):
                 raise ConflictException(
                     "You have already this session in your wishlist")
 
             # add to wishist
-            prof.sessionKeysOnWishlist.append(wssk)
+            self._storeNewProfile(prof)
+            userlists.add(WishlistEntry, prof.key, wssk)
             retval = True
 
         # remove from wishlist
         else:
             # check if user has entry in wishlist
-            if wssk in prof.sessionKeysOnWishlist:
+            if userlists.contains(WishlistEntry, prof.key, wssk):
 
                 # remove session from wishlist
-                prof.sessionKeysOnWishlist.remove(wssk)
+                userlists.remove(WishlistEntry, prof.key, wssk)
                 retval = True
             else:
                 retval = False
 
-        # write things back to the datastore & return
-        prof.put()
+        # only the wishlist entry was written
         return BooleanMessage(data=retval)
 
     @endpoints.method(
-            message_types.VoidMessage, SessionForms,
+            CONF_LIST_REQUEST, SessionForms,
             path='wishlist',
             http_method='GET', name='getSessionsInWishlist')
     def getSessionsInWishlist(self, request):
         """Get list of sessions that user has on their wishlist."""
         prof = self._getProfileFromUser()  # get user Profile
-        sess_keys = [ndb.Key(urlsafe=wssk)
-                     for wssk in prof.sessionKeysOnWishlist]
-        sessions = ndb.get_multi(sess_keys)
+        self._migrateUserLists(prof)
+        entry_keys, next_page = self._fetchPage(
+            userlists.query(WishlistEntry, prof.key), request, keys_only=True)
+        with rpcstats.phase('speakers'):
+            sessions, speakers = self._getSessionsWithSpeakers(
+                userlists.toKeys(entry_keys))
 
         # return set of SessionFormOut objects per Session
-        return SessionForms(items=[
-            self._copySessionToForm(sess)
-            for sess in sessions]
-        )
+        return self._copySessionsToForms(sessions, next_page,
+                                         speakers=speakers)
+
+    @endpoints.method(
+            message_types.VoidMessage, ScheduleForm,
+            path='wishlist/schedule',
+            http_method='GET', name='getWishlistSchedule')
+    def getWishlistSchedule(self, request):
+        """Return overlapping sessions on the user's wishlist and a
+        largest conflict-free schedule of them."""
+        prof = self._getProfileFromUser()  # get user Profile
+        self._migrateUserLists(prof)
+        entry_keys = userlists.query(WishlistEntry, prof.key).fetch(
+            keys_only=True)
+        sessions = [sess for sess in
+                    ndb.get_multi(userlists.toKeys(entry_keys)) if sess]
+        summaries = []
+        for sess in sessions:
+            summary = self._copySessionToSummary(sess)
+            summary.durationInMins = sess.durationInMins
+            summaries.append(summary)
+        return self._copyTimetableToForm(timetable.fromSessions(sessions),
+                                         summaries)
+
+    def _getSessionsWithSpeakers(self, sess_keys):
+        """Fetch sessions, then all of their speakers in one batch; the
+        speaker keys are only known once the sessions are read."""
+        sessions = [sess for sess in ndb.get_multi(sess_keys) if sess]
+        return sessions, self._getSpeakersOfSessions(sessions)
 
     @endpoints.method(
             SESS_GET_REQUEST, BooleanMessage,
@@ -1156,7 +1788,7 @@ class ConferenceApi(remote.Service):
     def ___QUERY_PROBLEM():
         pass # marked as a divider in function tree view
 
-    @endpoints.method(CONF_GET_REQUEST,
+    @endpoints.method(SESS_PAGE_REQUEST,
                       SessionForms,
                       path='conference/{websafeConferenceKey}/queryproblem',
                       http_method='GET',
@@ -1172,22 +1804,151 @@ class ConferenceApi(remote.Service):
         # is the conference existing?
         if conf.get() is None:
             raise endpoints.NotFoundException('Conference not found')
-        # get all sessions in the conference
-        sessions = Session.query(ancestor=conf)
-        # filter by start time
-        sessions = sessions.filter(
-            Session.startTime < datetime.strptime("19:00", "%H:%M").time())
-        # get the sessions and filter in python
-        filtered_sessions = [
-            session for session in sessions.fetch()
-            if session.typeOfSession != "WORKSHOP"]
-        # filter by start time not None
+        # get all sessions in the conference before 7 pm that are no
+        # workshops; the query engine runs the start time filter in the
+        # datastore and the session type filter in python
+        query, residual = self._applyFilters(
+            sessionkeys.query(conf), Session, [
+                {"field": "startTime", "operator": "<",
+                 "value": datetime.strptime("19:00", "%H:%M").time()},
+                {"field": "typeOfSession", "operator": "!=",
+                 "value": "WORKSHOP"},
+            ], scope=sessionkeys.scopeFields())
+        filtered_sessions, next_page = self._fetchPage(
+            query, request, residual)
+        # filter by start time not None, which the datastore sorts before
+        # any time; a page may hold fewer than pageSize sessions after this
         filtered_sessions = [
             session for session in filtered_sessions if session.startTime]
         # return individual SessionFormOut object per Session
-        return SessionForms(
-            items=[self._copySessionToForm(session)
-                   for session in filtered_sessions])
+        return self._copySessionsToForms(filtered_sessions, next_page)
+
+# - - - Search - - - - - - - - - - - - - - - - - - - - - - -
+    def ____SEARCH_PART():
+        pass # marked as a divider in function tree view
+
+    def _searchPage(self, kind, request, accept=None):
+        """Return the entities of the requested page of a ranked search,
+        and the token of the next page."""
+        if not request.query:
+            raise endpoints.BadRequestException("'query' field required")
+        # never return all results at once
+        request.pageSize = request.pageSize or DEFAULT_PAGE_SIZE
+        ranking, next_page = self._pageItems(
+            search.search(kind, request.query, accept), request)
+        entities = ndb.get_multi([ndb.Key(urlsafe=wsk)
+                                  for wsk, score in ranking])
+        return [entity for entity in entities if entity], next_page
+
+    @endpoints.method(SEARCH_REQUEST, ConferenceForms,
+            path='conferences/search',
+            http_method='GET', name='searchConferences')
+    def searchConferences(self, request):
+        """Search conference names, descriptions, topics and cities,
+        best matches first."""
+        conferences, next_page = self._searchPage('Conference', request)
+        return ConferenceForms(
+            items=[self._copyConferenceToForm(conf) for conf in conferences],
+            nextPageToken=next_page
+        )
+
+    @endpoints.method(SESS_SEARCH_REQUEST, SessionForms,
+            path='sessions/search',
+            http_method='GET', name='searchSessions')
+    def searchSessions(self, request):
+        """Search session names, highlights and locations, optionally
+        of one conference, best matches first."""
+        accept = None
+        if request.websafeConferenceKey:
+            conf = ndb.Key(urlsafe=request.websafeConferenceKey)
+            if conf.kind() != 'Conference':
+                raise endpoints.BadRequestException(
+                    'Provided key is not a conference key')
+            if sessionkeys.getLayout() == sessionkeys.ANCESTOR:
+                accept = lambda wssk: ndb.Key(urlsafe=wssk).parent() == conf
+            else:
+                # flat session keys don't name their conference
+                wssks = set(sess_key.urlsafe() for sess_key in
+                            sessionkeys.query(conf).fetch(keys_only=True))
+                accept = lambda wssk: wssk in wssks
+        sessions, next_page = self._searchPage('Session', request, accept)
+        return self._copySessionsToForms(sessions, next_page)
+
+    @staticmethod
+    def _reindexSearch(websafeCursor=None):
+        """Add a batch of conferences with their sessions to the search
+        index; used by main.ReindexSearchHandler, which is re-enqueued
+        with the returned cursor until all conferences are done.
+        """
+        cursor = Cursor(urlsafe=websafeCursor) if websafeCursor else None
+        conf_keys, next_cursor, more = Conference.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        sess_keys = [sess_key for conf_key in conf_keys
+                     for sess_key in sessionkeys.query(conf_key)
+                                                .fetch(keys_only=True)]
+        search.indexDocuments(conf_keys + sess_keys)
+        logging.info("_reindexSearch: %d conferences, %d sessions indexed"
+            % (len(conf_keys), len(sess_keys)))
+        if more and next_cursor:
+            return next_cursor.urlsafe()
+
+# - - - Organizer displayName - - - - - - - - - - - - - - - -
+    def ____ORGANIZER_NAME_PART():
+        pass # marked as a divider in function tree view
+
+    @staticmethod
+    def _updateOrganizerDisplayName(userId):
+        """Copy the Profile displayName to all conferences of the user;
+        used by main.UpdateOrganizerNameHandler.
+        """
+        p_key = ndb.Key(Profile, userId)
+        prof = p_key.get()
+        if not prof:
+            return 0
+        changed = [conf.key for conf in Conference.query(ancestor=p_key)
+                   if conf.organizerDisplayName != prof.displayName
+                   and ConferenceApi._setOrganizerDisplayName(
+                       conf.key, prof.displayName)]
+        if changed:
+            queryengine.bumpGeneration('Conference')
+        return len(changed)
+
+    @staticmethod
+    @ndb.transactional()
+    def _setOrganizerDisplayName(conf_key, displayName):
+        """Set organizerDisplayName of a conference, read again in the
+        transaction so concurrent edits of other fields are kept.
+
+        Returns True if the conference was changed.
+        """
+        conf = conf_key.get()
+        if not conf or conf.organizerDisplayName == displayName:
+            return False
+        conf.organizerDisplayName = displayName
+        conf.put()
+        cache.invalidate(cache.CONFERENCE, conf_key.urlsafe())
+        return True
+
+    @staticmethod
+    def _migrateOrganizerDisplayNames(websafeCursor=None):
+        """Fill organizerDisplayName of existing conferences batch by batch;
+        used by main.MigrateOrganizerNamesHandler, which is re-enqueued
+        with the returned cursor until all conferences are done.
+        """
+        cursor = Cursor(urlsafe=websafeCursor) if websafeCursor else None
+        confs, next_cursor, more = Conference.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor)
+        profiles = ndb.get_multi([conf.key.parent() for conf in confs])
+        changed = [conf.key for conf, prof in zip(confs, profiles)
+                   if prof and conf.organizerDisplayName != prof.displayName
+                   and ConferenceApi._setOrganizerDisplayName(
+                       conf.key, prof.displayName)]
+        if changed:
+            queryengine.bumpGeneration('Conference')
+        logging.info("_migrateOrganizerDisplayNames: %d of %d updated"
+            % (len(changed), len(confs)))
+        if more and next_cursor:
+            return next_cursor.urlsafe()
 
 # - - - Announcements - - - - - - - - - - - - - - - - - - - -
     def ____ANNOUNCE_PART():
@@ -1196,29 +1957,11 @@ class ConferenceApi(remote.Service):
     # _TODO 1 static method to set cache; used by main.SetAnnouncementHandler
     @staticmethod
     def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
+        """Reconcile the nearly sold out conferences & their announcement;
+        used by memcache cron job. Registrations keep them up to date
+        in between, see announcements.seatsChanged().
         """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
-
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = '%s %s' % (
-                'Last chance to attend! The following conferences '
-                'are nearly sold out:',
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
-
-        return announcement
+        return announcements.reconcile()
 
     @endpoints.method(message_types.VoidMessage,
                       StringMessage,
@@ -1228,66 +1971,62 @@ class ConferenceApi(remote.Service):
     def getAnnouncement(self, request):
         """Return Announcement from memcache."""
         # _TODO 1
-        # return an existing announcement from Memcache or an empty string.
-        announcement = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
-        if not announcement:
-            announcement = ""
-        return StringMessage(data=announcement)
+        # return the current announcement version or an empty string.
+        return StringMessage(data=announcements.getAnnouncement())
+
+# - - - Cache - - - - - - - - - - - - - - - - - - - - - - - -
+    def ____CACHE_PART():
+        pass # marked as a divider in function tree view
+
+    @endpoints.method(message_types.VoidMessage, CacheStatForms,
+                      path='cache/stats',
+                      http_method='GET',
+                      name='getCacheStats')
+    def getCacheStats(self, request):
+        """Return hit and miss counters of the entity cache."""
+        return CacheStatForms(items=[
+            CacheStatForm(kind=kind, hits=hits, misses=misses)
+            for kind, hits, misses in cache.getStats()])
 
 #  - - - - - - Feature Speaker - - - - - -
     def ____FEATURE_SPEAKER():
         pass # marked as a divider in function tree view
 
-    @staticmethod
-    def _cacheFeaturedSpeaker(websafeConferenceKey, sessionId):
-        """Search for featured speaker & assign to memcache; used by
-        main.SearchFeaturedSpeakers
-        """
-        logging.info("_cacheFeaturedSpeaker: Checking for featured speakers in %s %s\n"
-            % (websafeConferenceKey, sessionId))
-        # get the conference
-        conf = ndb.Key(urlsafe=websafeConferenceKey)
-        if conf.kind() != 'Conference':
-            # raising an exception causes another attempt at calling the task
-            logging.error("_cacheFeaturedSpeaker: provided conference key %s invalid"
-                % websafeConferenceKey)
-            return
-        # get the session; check if it exists
-        session = Session.get_by_id(int(sessionId), parent=conf)
-        if not session:
-            # raise endpoints.NotFoundException('Provided session not found')
-            # raising an exception causes another attempt at calling the task
-            logging.error("_cacheFeaturedSpeaker: provided session id not found %d"
-                % sessionId)
-            return
-        # Now check the speakers in the session
-        for speaker in session.speaker:
-            logging.info("_cacheFeaturedSpeaker: speaker %s in check"
-                % speaker.urlsafe())
-            sessions = Session.query(Session.speaker == speaker) \
-                              .fetch(projection=[Session.name])
-            logging.info("_cacheFeaturedSpeaker: %s sessions found" % len(sessions))
-            if len(sessions) > 1:
-                speaker = speaker.get()
-                # good - let's feature the speaker!
-                feature = FEATUREDSPEAKER_TPL % (
-                    speaker.name,
-                    ', '.join(sess.name for sess in sessions))
-                # set into memcache
-                memcache.set(MEMCACHE_FEATUREDSPEAKER_KEY, feature)
-                # we are done and return already
-                logging.info("_cacheFeaturedSpeaker: we found something\n%s" % feature)
-                return feature
+    def _searchFeaturedSpeakers(self, conf, sessionIds=()):
+        """Queue changed sessions for the featured speaker worker, which
+        coalesces them per conference."""
+        featured.enqueue(conf, sessionIds)
 
+    @endpoints.method(
+            message_types.VoidMessage, QueueStatsForm,
+            path='featured_speaker/queue_stats',
+            http_method='GET', name='getFeaturedSpeakerQueueStats')
+    def getFeaturedSpeakerQueueStats(self, request):
+        """Return depth and coalescing counters of the featured speaker
+        queue."""
+        return QueueStatsForm(**featured.getQueueStats())
 
     @endpoints.method(
-            message_types.VoidMessage, StringMessage,
-            path='featured_speaker',
+            message_types.VoidMessage, NotificationStatsForm,
+            path='notifications/queue_stats',
+            http_method='GET', name='getNotificationQueueStats')
+    def getNotificationQueueStats(self, request):
+        """Return backlog and throughput of the notification queue."""
+        return NotificationStatsForm(**notifications.getQueueStats())
+
+
+    @endpoints.method(
+            CONF_GET_REQUEST, StringMessage,
+            path='conference/{websafeConferenceKey}/featured_speaker',
             http_method='GET', name='getFeaturedSpeaker')
     def getFeaturedSpeaker(self, request):
-        """Return featured speaker from memcache."""
-        return StringMessage(
-            data=memcache.get(MEMCACHE_FEATUREDSPEAKER_KEY) or "")
+        """Return featured speaker of a conference from memcache."""
+        conf = ndb.Key(urlsafe=request.websafeConferenceKey)
+        if conf.kind() != 'Conference':
+            raise endpoints.BadRequestException(
+                'Provided key is not a conference key')
+        return StringMessage(data=featured.getAnnouncement(conf))
 
 
-api = endpoints.api_server([ConferenceApi]) # register API
+# register API; every request is recorded by rpcstats
+api = rpcstats.Middleware(endpoints.api_server([ConferenceApi]))
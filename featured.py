@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+"""
+featured.py -- per-conference featured speaker index
+
+For every conference a FeaturedSpeakerIndex entity maps each session
+to its name and speakers, and each speaker to its session count. The
+index is updated incrementally for the sessions that changed, and it
+keeps the featured speaker (the one with most sessions, at least two)
+up to date, so reading it needs no Session query at all. The resulting
+announcement is cached in memcache under a per-conference key.
+
+Changed sessions are queued as pull tasks. A single worker, enqueued
+at most once per COALESCE_WINDOW, leases them in batches and updates
+each affected conference once, however many tasks it had. The indexes
+of conferences created before are built by backfillBatch().
+
+"""
+
+import json
+import logging
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import FeaturedSpeakerIndex
+
+import sessionkeys
+
+MEMCACHE_FEATUREDSPEAKER_KEY = "FEATURED_SPEAKER_%s"
+FEATUREDSPEAKER_TPL = (
+    'Speaker %s is our feature speaker, will appear in these sessions: %s')
+PULL_QUEUE = "featured-speakers"
+COALESCE_WINDOW = 5             # seconds
+LEASE_SECONDS = 60
+LEASE_BATCH_SIZE = 1000
+MAX_TASK_RETRIES = 5
+MEMCACHE_QUEUE_STATS_PREFIX = "FEATURED_QUEUE_"
+BACKFILL_BATCH_SIZE = 20        # conferences
+
+
+def _indexKey(conf_key):
+    return ndb.Key(FeaturedSpeakerIndex, conf_key.urlsafe())
+
+
+def _pickFeatured(counts, current):
+    """Return the speaker with most sessions, keeping current on ties."""
+    best = current if counts.get(current, 0) > 1 else None
+    for wssk, count in counts.items():
+        if count > 1 and count > counts.get(best, 0):
+            best = wssk
+    return best
+
+
+@ndb.transactional()
+def _applySessions(conf_key, sessions):
+    """Replace the index entries of the given sessions.
+
+    sessions maps session id strings to Session entities, or to None
+    for sessions that no longer exist.
+    """
+    index = _indexKey(conf_key).get()
+    if not index:
+        index = FeaturedSpeakerIndex(key=_indexKey(conf_key),
+                                     sessions={}, counts={})
+    for sessionId, sess in sessions.items():
+        old = index.sessions.pop(sessionId, None)
+        if old:
+            for wssk in old['speakers']:
+                index.counts[wssk] -= 1
+                if not index.counts[wssk]:
+                    del index.counts[wssk]
+        if sess:
+            speakers = sorted(set(key.urlsafe() for key in sess.speaker))
+            index.sessions[sessionId] = {'name': sess.name,
+                                         'speakers': speakers}
+            for wssk in speakers:
+                index.counts[wssk] = index.counts.get(wssk, 0) + 1
+    index.featured = _pickFeatured(index.counts, index.featured)
+    index.put()
+    return index
+
+
+def _announcement(index):
+    """Format the featured speaker announcement of an index."""
+    if not index or not index.featured:
+        return ""
+    speaker = ndb.Key(urlsafe=index.featured).get()
+    names = sorted(entry['name'] for entry in index.sessions.values()
+                   if index.featured in entry['speakers'])
+    return FEATUREDSPEAKER_TPL % (getattr(speaker, 'name', ''),
+                                  ', '.join(names))
+
+
+def update(conf_key, sessionIds):
+    """Apply changed sessions to the index and cache the announcement.
+
+    With no sessionIds, only the cached announcement is refreshed
+    (e.g. after a speaker was renamed).
+    """
+    if sessionIds:
+        sessions = sessionkeys.getMulti(conf_key, sessionIds)
+        index = _applySessions(conf_key, dict(zip(sessionIds, sessions)))
+    else:
+        index = _indexKey(conf_key).get()
+    announcement = _announcement(index)
+    memcache.set(MEMCACHE_FEATUREDSPEAKER_KEY % conf_key.urlsafe(),
+                 announcement)
+    return announcement
+
+
+def backfillBatch(websafeCursor=None):
+    """Build the index of one batch of conferences from all of their
+    sessions.
+
+    Returns the cursor of the next batch, or None when all conferences
+    are done.
+    """
+    cursor = Cursor(urlsafe=websafeCursor) if websafeCursor else None
+    conf_keys, next_cursor, more = Conference.query().fetch_page(
+        BACKFILL_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+    for conf_key in conf_keys:
+        sessionIds = [str(sess_key.id()) for sess_key in
+                      sessionkeys.query(conf_key).fetch(keys_only=True)]
+        update(conf_key, sessionIds)
+    logging.info("backfillBatch: %d conferences indexed" % len(conf_keys))
+    if more and next_cursor:
+        return next_cursor.urlsafe()
+
+
+def getAnnouncement(conf_key):
+    """Return the featured speaker announcement of a conference."""
+    cache_key = MEMCACHE_FEATUREDSPEAKER_KEY % conf_key.urlsafe()
+    announcement = memcache.get(cache_key)
+    if announcement is None:
+        announcement = _announcement(_indexKey(conf_key).get())
+        memcache.set(cache_key, announcement)
+    return announcement
+
+
+def enqueue(conf_key, sessionIds=()):
+    """Queue changed sessions of a conference for the worker."""
+    taskqueue.Queue(PULL_QUEUE).add(taskqueue.Task(
+        payload=json.dumps({'websafeConferenceKey': conf_key.urlsafe(),
+                            'sessionIds': [str(sessionId)
+                                           for sessionId in sessionIds]}),
+        method='PULL'))
+    scheduleWorker()
+
+
+def scheduleWorker():
+    """Enqueue the worker, at most once per time window."""
+    window = int(time.time() // COALESCE_WINDOW)
+    try:
+        taskqueue.add(name='featured-speakers-%d' % window,
+                      url='/tasks/search_featured_speakers',
+                      countdown=COALESCE_WINDOW)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def processQueue():
+    """Lease a batch of queued changes and update each conference once.
+
+    Returns the number of leased tasks and of updated conferences.
+    """
+    queue = taskqueue.Queue(PULL_QUEUE)
+    tasks = queue.lease_tasks(LEASE_SECONDS, LEASE_BATCH_SIZE)
+
+    # coalesce the tasks per conference
+    changes = {}
+    for task in tasks:
+        payload = json.loads(task.payload)
+        entry = changes.setdefault(payload['websafeConferenceKey'],
+                                   {'tasks': [], 'sessionIds': set()})
+        entry['tasks'].append(task)
+        entry['sessionIds'].update(payload['sessionIds'])
+
+    done = []
+    failed = False
+    for wsck, entry in changes.items():
+        try:
+            update(ndb.Key(urlsafe=wsck), sorted(entry['sessionIds']))
+            done.extend(entry['tasks'])
+        except Exception:
+            # tasks of this conference are released for the next run,
+            # unless they failed too often already
+            logging.exception("processQueue: updating %s failed" % wsck)
+            failed = True
+            for task in entry['tasks']:
+                if task.retry_count >= MAX_TASK_RETRIES:
+                    done.append(task)
+                else:
+                    queue.modify_task_lease(task, 0)
+    if done:
+        queue.delete_tasks(done)
+
+    memcache.offset_multi({'runs': 1, 'tasks': len(tasks),
+                           'conferences': len(changes)},
+                          key_prefix=MEMCACHE_QUEUE_STATS_PREFIX,
+                          initial_value=0)
+    logging.info("processQueue: %d tasks coalesced into %d conferences"
+        % (len(tasks), len(changes)))
+
+    # more work left, or released tasks to retry: run again in the next
+    # window
+    if failed or len(tasks) >= LEASE_BATCH_SIZE:
+        scheduleWorker()
+    return len(tasks), len(changes)
+
+
+def getQueueStats():
+    """Return queue depth and worker counters as a dict."""
+    counters = memcache.get_multi(['runs', 'tasks', 'conferences'],
+                                  key_prefix=MEMCACHE_QUEUE_STATS_PREFIX)
+    runs = int(counters.get('runs') or 0)
+    tasks = int(counters.get('tasks') or 0)
+    conferences = int(counters.get('conferences') or 0)
+    return {
+        'depth': taskqueue.Queue(PULL_QUEUE).fetch_statistics().tasks,
+        'runs': runs,
+        'tasks': tasks,
+        'conferences': conferences,
+        'batchSize': float(tasks) / runs if runs else 0.0,
+        'coalescingRatio': float(tasks) / conferences if conferences else 0.0,
+    }
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+"""
+indexadvisor.py -- derive composite indexes from recorded query plans
+
+Reads the plans recorded by queryengine.recordPlan(), as returned by
+/_admin/query_plans, and prints the index.yaml entries they need.
+
+By default the smallest set is derived: the datastore answers several
+equality filters by merge-joining one index per equality field, as long
+as all of them end in the same inequality field and sort orders, so a
+plan with equality fields E needs one (e, inequality, orders...) index
+per e in E rather than one index per combination of E. Projection
+queries cannot merge-join and get one exact index each; --exact does the
+same for all plans, trading index storage for fewer index scans. Plans
+of ancestor queries get ancestor indexes, which are never built in.
+
+usage: python indexadvisor.py [--exact] [--min-count N] [plans.json]
+       (plans.json defaults to stdin)
+
+"""
+
+import argparse
+import json
+import sys
+
+# indexes the datastore provides without index.yaml entries
+BUILT_IN_ORDERS = (['name'],)
+
+
+def _exactIndex(plan):
+    properties = list(plan['equalities'])
+    for prop in plan['orders'] + plan['projection']:
+        if prop not in properties:
+            properties.append(prop)
+    return properties
+
+
+def indexesOf(plan, exact=False):
+    """Return the property lists of the indexes a plan needs."""
+    if exact or plan['projection']:
+        return [_exactIndex(plan)]
+    suffix = plan['orders']
+    if not plan['equalities']:
+        if not plan.get('ancestor') and (suffix in BUILT_IN_ORDERS
+                                         or len(suffix) <= 1):
+            return []
+        return [suffix]
+    return [[field] + [prop for prop in suffix if prop != field]
+            for field in plan['equalities']]
+
+
+def advise(plans, exact=False, min_count=0):
+    """Return the sorted, distinct (kind, ancestor, properties) indexes of
+    plans."""
+    indexes = set()
+    for plan in plans:
+        if plan.get('count', 0) < min_count:
+            continue
+        ancestor = bool(plan.get('ancestor'))
+        for properties in indexesOf(plan, exact):
+            if properties and (ancestor or len(properties) > 1):
+                indexes.add((plan['kind'], ancestor, tuple(properties)))
+    return sorted(indexes)
+
+
+def toYaml(indexes):
+    lines = ['indexes:', '']
+    for kind, ancestor, properties in indexes:
+        lines.append('- kind: %s' % kind)
+        if ancestor:
+            lines.append('  ancestor: yes')
+        lines.append('  properties:')
+        lines.extend('  - name: %s' % prop for prop in properties)
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Derive index.yaml entries from recorded query plans.')
+    parser.add_argument('plans', nargs='?', type=argparse.FileType('r'),
+                        default=sys.stdin)
+    parser.add_argument('--exact', action='store_true',
+                        help='one exact index per plan, no merge joins')
+    parser.add_argument('--min-count', type=int, default=0,
+                        help='ignore plans run fewer times')
+    args = parser.parse_args()
+    print toYaml(advise(json.load(args.plans), args.exact, args.min_count))
+
+
+if __name__ == '__main__':
+    main()
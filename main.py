@@ -12,10 +12,20 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import json
 import webapp2
-from google.appengine.api import app_identity
-from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
 from conference import ConferenceApi
+import featured
+import notifications
+import queryengine
+import rpcstats
+import search
+import seats
+import sessionkeys
+import settings
+import userlists
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
@@ -27,30 +37,200 @@ class SetAnnouncementHandler(webapp2.RequestHandler):
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     # the handler of sending email is a POST request
     def post(self):
-        """Send email confirming Conference creation."""
-        mail.send_mail(
-            'noreply@%s.appspotmail.com' % (
-                app_identity.get_application_id()),     # from
+        """Queue email confirming Conference creation; only drains tasks
+        enqueued before confirmations went to the notification queue."""
+        conferenceInfo = self.request.get('conferenceInfo')
+        notifications.enqueue(
             self.request.get('email'),                  # to
             'You created a new Conference!',            # subj
             'Hi, you have created a following '         # body
-            'conference:\r\n\r\n%s' % self.request.get(
-                'conferenceInfo')
-        )
+            'conference:\r\n\r\n%s' % conferenceInfo,
+            conferenceInfo)                             # dedup key
+        self.response.set_status(204)
+
+
+class SendNotificationsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Send one rate-limited batch of queued notifications."""
+        notifications.processQueue()
+        self.response.set_status(204)
 
 
 class SearchFeaturedSpeakers(webapp2.RequestHandler):
     def post(self):
-        """Check if speakers in session are featured."""
+        """Update featured speakers of conferences with changed sessions."""
         print "searching Featuring Speaker"
-        ConferenceApi._cacheFeaturedSpeaker(
-            self.request.get('websafeConferenceKey'),
-            self.request.get('sessionId'))
+        featured.processQueue()
+        self.response.set_status(204)
+
+
+class UpdateOrganizerNameHandler(webapp2.RequestHandler):
+    def post(self):
+        """Copy changed Profile displayName to the user's conferences."""
+        ConferenceApi._updateOrganizerDisplayName(self.request.get('userId'))
+        self.response.set_status(204)
+
+
+class MigrateOrganizerNamesHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start filling organizerDisplayName of existing conferences."""
+        self.post()
+
+    def post(self):
+        """Migrate one batch of conferences, then enqueue the next one."""
+        cursor = ConferenceApi._migrateOrganizerDisplayNames(
+            self.request.get('cursor') or None)
+        if cursor:
+            taskqueue.add(params={'cursor': cursor},
+                url='/tasks/migrate_organizer_names')
+        self.response.set_status(204)
+
+
+class MigrateUserListsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start moving profile list entries to child entities."""
+        self.post()
+
+    def post(self):
+        """Migrate one batch of profiles, then enqueue the next one."""
+        cursor = userlists.migrateBatch(self.request.get('cursor') or None)
+        if cursor:
+            taskqueue.add(params={'cursor': cursor},
+                url='/tasks/migrate_user_lists')
+        self.response.set_status(204)
+
+
+class BackfillFeaturedSpeakersHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start building the featured speaker index of all conferences."""
+        self.post()
+
+    def post(self):
+        """Index one batch of conferences, then enqueue the next one."""
+        cursor = featured.backfillBatch(self.request.get('cursor') or None)
+        if cursor:
+            taskqueue.add(params={'cursor': cursor},
+                url='/tasks/backfill_featured_speakers')
+        self.response.set_status(204)
+
+
+class MigrateSessionKeysHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start moving sessions into the configured key layout."""
+        self.post()
+
+    def post(self):
+        """Move the sessions of one batch of conferences, or once all
+        are done the wishlist entries of moved sessions, then enqueue
+        the next batch."""
+        phase = self.request.get('phase') or 'sessions'
+        cursor = self.request.get('cursor') or None
+        if phase == 'sessions':
+            cursor = ConferenceApi._migrateSessionKeys(cursor)
+            if not cursor:
+                phase = 'wishlists'
+        else:
+            cursor = sessionkeys.migrateWishlistBatch(cursor)
+            if not cursor:
+                phase = None
+        if phase:
+            params = {'phase': phase}
+            if cursor:
+                params['cursor'] = cursor
+            taskqueue.add(params=params, url='/tasks/migrate_session_keys')
+        self.response.set_status(204)
+
+
+class ReindexSpeakersHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start filling the name index of existing speakers."""
+        self.post()
+
+    def post(self):
+        """Reindex one batch of speakers, then enqueue the next one."""
+        cursor = ConferenceApi._reindexSpeakers(
+            self.request.get('cursor') or None)
+        if cursor:
+            taskqueue.add(params={'cursor': cursor},
+                url='/tasks/reindex_speakers')
+        self.response.set_status(204)
+
+
+class IndexSearchHandler(webapp2.RequestHandler):
+    def post(self):
+        """Reindex conferences and sessions queued for the search index."""
+        search.processQueue()
+        self.response.set_status(204)
+
+
+class ReindexSearchHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start adding existing conferences & sessions to the index."""
+        self.post()
+
+    def post(self):
+        """Index one batch of conferences, then enqueue the next one."""
+        cursor = ConferenceApi._reindexSearch(
+            self.request.get('cursor') or None)
+        if cursor:
+            taskqueue.add(params={'cursor': cursor},
+                url='/tasks/reindex_search')
+        self.response.set_status(204)
+
+
+class RebuildScheduleHandler(webapp2.RequestHandler):
+    def post(self):
+        """Rebuild the session schedule snapshot of a conference."""
+        ConferenceApi._rebuildSchedule(
+            self.request.get('websafeConferenceKey'))
+        self.response.set_status(204)
+
+
+class ReconcileSeatsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Write the sharded seat count back to the Conference."""
+        seats.reconcileSeats(
+            ndb.Key(urlsafe=self.request.get('websafeConferenceKey')))
         self.response.set_status(204)
 
 
+class StatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return the aggregated per-request RPC stats as JSON."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(rpcstats.getStats(), indent=2,
+                                       sort_keys=True))
+
+
+class QueryPlansHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return the recorded query plans as JSON, for indexadvisor.py."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(
+            queryengine.getPlanStats('Conference') +
+            queryengine.getPlanStats('Session'), indent=2, sort_keys=True))
+
+
 app = webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
+    ('/tasks/send_notifications', SendNotificationsHandler),
     ('/tasks/search_featured_speakers', SearchFeaturedSpeakers),
+    ('/tasks/reconcile_seats', ReconcileSeatsHandler),
+    ('/tasks/update_organizer_name', UpdateOrganizerNameHandler),
+    ('/tasks/migrate_organizer_names', MigrateOrganizerNamesHandler),
+    ('/tasks/migrate_user_lists', MigrateUserListsHandler),
+    ('/tasks/migrate_session_keys', MigrateSessionKeysHandler),
+    ('/tasks/backfill_featured_speakers', BackfillFeaturedSpeakersHandler),
+    ('/tasks/reindex_speakers', ReindexSpeakersHandler),
+    ('/tasks/index_search', IndexSearchHandler),
+    ('/tasks/reindex_search', ReindexSearchHandler),
+    ('/tasks/rebuild_schedule', RebuildScheduleHandler),
+    ('/_admin/stats', StatsHandler),
+    ('/_admin/query_plans', QueryPlansHandler),
 ], debug=True)
+# every request is recorded by rpcstats
+app = rpcstats.Middleware(app)
+
+notifications.setTransport(
+    notifications.TRANSPORTS[settings.NOTIFICATION_TRANSPORT])
@@ -16,6 +16,8 @@ import endpoints
 from protorpc import messages
 from google.appengine.ext import ndb
 
+import textutil
+
 
 class ConflictException(endpoints.ServiceException):
     """ConflictException -- exception mapped to HTTP 409 response"""
@@ -27,9 +29,18 @@ class Profile(ndb.Model):
     """Profile -- User profile object"""
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
+    # legacy lists, moved to Attendance/WishlistEntry by userlists.migrate()
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
     sessionKeysOnWishlist = ndb.StringProperty(repeated=True)
 
+class Attendance(ndb.Model):
+    """Attendance -- Profile child, id is the websafe Conference key"""
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+class WishlistEntry(ndb.Model):
+    """WishlistEntry -- Profile child, id is the websafe Session key"""
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
 # contains only 2 forms for editable users
 class ProfileMiniForm(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
@@ -57,6 +68,7 @@ class Conference(ndb.Model):
     name            = ndb.StringProperty(required=True)
     description     = ndb.StringProperty()
     organizerUserId = ndb.StringProperty()
+    organizerDisplayName = ndb.StringProperty(indexed=False)
     topics          = ndb.StringProperty(repeated=True)
     city            = ndb.StringProperty()
     startDate       = ndb.DateProperty()
@@ -65,6 +77,16 @@ class Conference(ndb.Model):
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
 
+class NearSoldOut(ndb.Model):
+    """NearSoldOut -- nearly sold out conferences and their announcement"""
+    conferences     = ndb.JsonProperty()
+    announcement    = ndb.TextProperty(default='')
+    version         = ndb.IntegerProperty(default=0, indexed=False)
+
+class SeatShard(ndb.Model):
+    """SeatShard -- one shard of the available seats of a Conference"""
+    seatsAvailable  = ndb.IntegerProperty(default=0)
+
 class ConferenceForm(messages.Message):
     """ConferenceForm -- Conference outbound form message"""
     name            = messages.StringField(1)
@@ -80,14 +102,25 @@ class ConferenceForm(messages.Message):
     websafeKey      = messages.StringField(11)
     organizerDisplayName = messages.StringField(12)
 
+class ConferenceSummaryForm(messages.Message):
+    """ConferenceSummaryForm -- Conference outbound summary message"""
+    name            = messages.StringField(1)
+    startDate       = messages.StringField(2)
+    websafeKey      = messages.StringField(3)
+
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    summaries = messages.MessageField(ConferenceSummaryForm, 3, repeated=True)
 
 
 class Speaker(ndb.Model):
     """Speaker -- Speaker object as stored in Data Store."""
     name = ndb.StringProperty(required=True)
+    # normalized words and full name, the prefix index of searchSpeakers()
+    nameTokens = ndb.ComputedProperty(
+        lambda self: textutil.prefixTokens(self.name), repeated=True)
 
 
 class SpeakerFormIn(messages.Message):
@@ -104,6 +137,7 @@ class SpeakerFormOut(messages.Message):
 class SpeakerForms(messages.Message):
     """SpeakerForms -- multiple Speaker outbound form message"""
     items = messages.MessageField(SpeakerFormOut, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
 
 
 class Session(ndb.Model):
@@ -119,6 +153,12 @@ class Session(ndb.Model):
     durationInMins = ndb.IntegerProperty()
     typeOfSession = ndb.StringProperty(default='NOT_SPECIFIED')
     location = ndb.StringProperty()
+    conferenceKey = ndb.KeyProperty(kind='Conference')
+
+class SessionMove(ndb.Model):
+    """SessionMove -- new key of a session moved to another key layout,
+    id is the old websafe Session key"""
+    target = ndb.KeyProperty(kind='Session', indexed=False)
 
 class SessionType(messages.Enum):
     """SessionType -- session type enumeration value"""
@@ -139,6 +179,10 @@ class SessionFormIn(messages.Message):
     typeOfSession = messages.EnumField(SessionType, 7)
     location = messages.StringField(8)
 
+class SessionFormsIn(messages.Message):
+    """SessionFormsIn -- multiple Session inbound form message"""
+    items = messages.MessageField(SessionFormIn, 1, repeated=True)
+
 class SessionFormOut(messages.Message):
     """SessionFormOut -- Session outbound form message"""
     name = messages.StringField(1, required=True)
@@ -152,9 +196,61 @@ class SessionFormOut(messages.Message):
     websafeConferenceKey = messages.StringField(9)
     sessionId = messages.StringField(10)
 
+class SessionSummaryForm(messages.Message):
+    """SessionSummaryForm -- Session outbound summary message"""
+    name = messages.StringField(1)
+    date = messages.StringField(2)
+    startTime = messages.StringField(3)
+    websafeConferenceKey = messages.StringField(4)
+    sessionId = messages.StringField(5)
+    durationInMins = messages.IntegerField(6)
+
+class SessionConflictForm(messages.Message):
+    """SessionConflictForm -- a pair of overlapping sessions"""
+    first = messages.MessageField(SessionSummaryForm, 1)
+    second = messages.MessageField(SessionSummaryForm, 2)
+
+class ScheduleForm(messages.Message):
+    """ScheduleForm -- conflict-free schedule and overlaps of sessions"""
+    schedule = messages.MessageField(SessionSummaryForm, 1, repeated=True)
+    conflicts = messages.MessageField(SessionConflictForm, 2, repeated=True)
+    conflictCount = messages.IntegerField(3)
+    untimed = messages.MessageField(SessionSummaryForm, 4, repeated=True)
+
 class SessionForms(messages.Message):
     """SessionForms -- multiple Session outbound form message"""
     items = messages.MessageField(SessionFormOut, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    summaries = messages.MessageField(SessionSummaryForm, 3, repeated=True)
+
+class ScheduleSnapshot(ndb.Model):
+    """ScheduleSnapshot -- compressed SessionForms schedule of a Conference,
+    keyed by the websafe Conference key."""
+    _use_memcache = False
+    data = ndb.BlobProperty(required=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+class FeaturedSpeakerIndex(ndb.Model):
+    """FeaturedSpeakerIndex -- sessions and session counts per speaker of
+    a Conference, keyed by the websafe Conference key."""
+    sessions = ndb.JsonProperty(compressed=True)
+    counts = ndb.JsonProperty()
+    featured = ndb.StringProperty(indexed=False)
+
+class SearchTerm(ndb.Model):
+    """SearchTerm -- postings of a term in one bucket, id is term#bucket,
+    {websafe key: [tf, length]}"""
+    postings = ndb.JsonProperty(compressed=True)
+
+class SearchDoc(ndb.Model):
+    """SearchDoc -- indexed term frequencies of a document"""
+    terms = ndb.JsonProperty(compressed=True)
+    length = ndb.IntegerProperty(indexed=False)
+
+class SearchStats(ndb.Model):
+    """SearchStats -- number and total length of indexed documents"""
+    docCount = ndb.IntegerProperty(default=0, indexed=False)
+    totalLength = ndb.IntegerProperty(default=0, indexed=False)
 
 class QueryForm(messages.Message):
     """QueryForm -- query inbound form message"""
@@ -162,6 +258,43 @@ class QueryForm(messages.Message):
     operator = messages.StringField(2)
     value = messages.StringField(3)
 
+class ListView(messages.Enum):
+    """ListView -- level of detail returned by list endpoints"""
+    FULL = 1
+    SUMMARY = 2
+
 class QueryForms(messages.Message):
     """QueryForms -- multiple QueryForm inbound form message"""
     filters = messages.MessageField(QueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2, variant=messages.Variant.INT32)
+    pageToken = messages.StringField(3)
+    view = messages.EnumField(ListView, 4, default='FULL')
+
+class CacheStatForm(messages.Message):
+    """CacheStatForm -- hit/miss counters of one cached kind"""
+    kind = messages.StringField(1)
+    hits = messages.IntegerField(2)
+    misses = messages.IntegerField(3)
+
+class CacheStatForms(messages.Message):
+    """CacheStatForms -- multiple CacheStatForm outbound form message"""
+    items = messages.MessageField(CacheStatForm, 1, repeated=True)
+
+class QueueStatsForm(messages.Message):
+    """QueueStatsForm -- depth and worker counters of a task queue"""
+    depth = messages.IntegerField(1)
+    runs = messages.IntegerField(2)
+    tasks = messages.IntegerField(3)
+    conferences = messages.IntegerField(4)
+    batchSize = messages.FloatField(5)
+    coalescingRatio = messages.FloatField(6)
+
+class NotificationStatsForm(messages.Message):
+    """NotificationStatsForm -- backlog and throughput of outbound email"""
+    depth = messages.IntegerField(1)
+    oldestTaskAgeSecs = messages.IntegerField(2)
+    runs = messages.IntegerField(3)
+    sent = messages.IntegerField(4)
+    failed = messages.IntegerField(5)
+    duplicates = messages.IntegerField(6)
+    sentPerMinute = messages.IntegerField(7)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+"""
+notifications.py -- batched, rate-limited outbound email
+
+Messages are queued as named pull tasks, named after the recipient and
+a deduplication key, so the same notification is queued only once. A
+single worker, enqueued at most once per WORKER_WINDOW, takes tokens
+from a memcache token bucket (MAIL_RATE messages per second, bursts of
+up to BUCKET_SIZE), leases that many tasks and hands them to the
+transport. Failed messages stay leased for an exponentially growing
+backoff and are dropped after MAX_TASK_RETRIES.
+
+The transport is a callable transport(sender, to, subject, body); it
+defaults to the App Engine mail API and can be replaced by
+setTransport(), e.g. by loggingTransport on a development server.
+main.py selects one of TRANSPORTS by settings.NOTIFICATION_TRANSPORT.
+
+"""
+
+import hashlib
+import json
+import logging
+import time
+
+from google.appengine.api import app_identity
+from google.appengine.api import mail
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+
+PULL_QUEUE = "notifications"
+WORKER_WINDOW = 5               # seconds
+LEASE_SECONDS = 60
+LEASE_BATCH_SIZE = 100
+MAIL_RATE = 2.0                 # messages per second
+BUCKET_SIZE = 100               # messages
+BACKOFF_BASE = 30               # seconds
+BACKOFF_CAP = 3600              # seconds
+MAX_TASK_RETRIES = 8
+MEMCACHE_BUCKET_KEY = "NOTIFICATIONS_BUCKET"
+MEMCACHE_STATS_PREFIX = "NOTIFICATIONS_"
+MEMCACHE_SENT_MINUTE_KEY = "sent_%d"
+
+
+def appEngineMailTransport(sender, to, subject, body):
+    """Send a message with the App Engine mail API."""
+    mail.send_mail(sender, to, subject, body)
+
+
+def loggingTransport(sender, to, subject, body):
+    """Log a message instead of sending it."""
+    logging.info("mail from %s to %s: %s\n%s" % (sender, to, subject, body))
+
+TRANSPORTS = {
+    'mail': appEngineMailTransport,
+    'logging': loggingTransport,
+}
+
+_transport = appEngineMailTransport
+
+
+def setTransport(transport):
+    """Replace the transport; returns the previous one."""
+    global _transport
+    previous, _transport = _transport, transport
+    return previous
+
+
+def _sender():
+    return 'noreply@%s.appspotmail.com' % app_identity.get_application_id()
+
+
+def enqueue(to, subject, body, dedupKey):
+    """Queue a message, unless one with the same recipient and
+    dedupKey was queued before; returns True if it was queued."""
+    name = 'mail-' + hashlib.sha1(
+        '%s\n%s' % (to, dedupKey)).hexdigest()
+    try:
+        taskqueue.Queue(PULL_QUEUE).add(taskqueue.Task(
+            name=name,
+            payload=json.dumps({'to': to, 'subject': subject,
+                                'body': body, 'dedupKey': dedupKey}),
+            method='PULL'))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        memcache.incr(MEMCACHE_STATS_PREFIX + 'duplicates', initial_value=0)
+        return False
+    scheduleWorker()
+    return True
+
+
+def scheduleWorker(countdown=WORKER_WINDOW):
+    """Enqueue the worker, at most once per time window."""
+    window = int((time.time() + countdown) // WORKER_WINDOW)
+    try:
+        taskqueue.add(name='notifications-%d' % window,
+                      url='/tasks/send_notifications',
+                      countdown=countdown)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def _adjustTokens(wanted):
+    """Take up to wanted tokens (or give back -wanted) from the bucket.
+
+    Returns the number of tokens taken.
+    """
+    client = memcache.Client()
+    for _ in range(5):
+        now = time.time()
+        state = client.gets(MEMCACHE_BUCKET_KEY)
+        tokens, stamp = state if state is not None else (BUCKET_SIZE, now)
+        tokens = min(BUCKET_SIZE, tokens + (now - stamp) * MAIL_RATE)
+        taken = int(min(tokens, wanted))
+        new_state = (tokens - taken, now)
+        if state is None:
+            if client.add(MEMCACHE_BUCKET_KEY, new_state):
+                return taken
+        elif client.cas(MEMCACHE_BUCKET_KEY, new_state):
+            return taken
+    return 0
+
+
+def _backoff(task):
+    return min(BACKOFF_CAP, BACKOFF_BASE * 2 ** task.retry_count)
+
+
+def processQueue():
+    """Send one rate-limited batch of queued messages.
+
+    Returns the number of sent and failed messages.
+    """
+    queue = taskqueue.Queue(PULL_QUEUE)
+    granted = _adjustTokens(LEASE_BATCH_SIZE)
+    if not granted:
+        # bucket is empty: wait until a token has been refilled
+        scheduleWorker(max(WORKER_WINDOW, int(1 / MAIL_RATE) + 1))
+        return 0, 0
+    tasks = queue.lease_tasks(LEASE_SECONDS, granted)
+    if len(tasks) < granted:
+        _adjustTokens(len(tasks) - granted)
+
+    done = []
+    sent = failed = duplicates = 0
+    retry_in = None
+    seen = set()
+    sender = _sender()
+    for task in tasks:
+        message = json.loads(task.payload)
+        if (message['to'], message['dedupKey']) in seen:
+            duplicates += 1
+            done.append(task)
+            continue
+        try:
+            _transport(sender, message['to'], message['subject'],
+                       message['body'])
+        except Exception:
+            logging.exception("processQueue: sending to %s failed"
+                % message['to'])
+            failed += 1
+            if task.retry_count >= MAX_TASK_RETRIES:
+                done.append(task)
+            else:
+                queue.modify_task_lease(task, _backoff(task))
+                retry_in = min(retry_in or BACKOFF_CAP, _backoff(task))
+            continue
+        seen.add((message['to'], message['dedupKey']))
+        sent += 1
+        done.append(task)
+    if done:
+        queue.delete_tasks(done)
+
+    memcache.offset_multi({'runs': 1, 'sent': sent, 'failed': failed,
+                           'duplicates': duplicates},
+                          key_prefix=MEMCACHE_STATS_PREFIX,
+                          initial_value=0)
+    minute_key = MEMCACHE_SENT_MINUTE_KEY % (int(time.time()) // 60)
+    memcache.add(minute_key, 0, time=180,
+                 namespace=MEMCACHE_STATS_PREFIX)
+    memcache.incr(minute_key, sent, namespace=MEMCACHE_STATS_PREFIX)
+    logging.info("processQueue: %d sent, %d failed, %d duplicates"
+        % (sent, failed, duplicates))
+
+    # more work left, and messages to retry once their backoff is over;
+    # the follow-up run may drain the queue before the backoff ends
+    if len(tasks) >= granted:
+        scheduleWorker()
+    if retry_in:
+        scheduleWorker(retry_in)
+    return sent, failed
+
+
+def getQueueStats():
+    """Return backlog, throughput and counters as a dict."""
+    counters = memcache.get_multi(['runs', 'sent', 'failed', 'duplicates'],
+                                  key_prefix=MEMCACHE_STATS_PREFIX)
+    last_minute = MEMCACHE_SENT_MINUTE_KEY % (int(time.time()) // 60 - 1)
+    stats = taskqueue.Queue(PULL_QUEUE).fetch_statistics()
+    oldest = stats.oldest_eta_usec
+    return {
+        'depth': stats.tasks,
+        'oldestTaskAgeSecs': (max(0, int(time.time() - oldest / 1e6))
+                              if oldest else 0),
+        'runs': int(counters.get('runs') or 0),
+        'sent': int(counters.get('sent') or 0),
+        'failed': int(counters.get('failed') or 0),
+        'duplicates': int(counters.get('duplicates') or 0),
+        'sentPerMinute': int(memcache.get(
+            last_minute, namespace=MEMCACHE_STATS_PREFIX) or 0),
+    }
@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+
+"""
+queryengine.py -- multi-inequality queries on top of the datastore
+
+The datastore only allows inequality filters on a single property.
+plan() splits a list of filters into the part the datastore can run
+(all equality filters plus the inequality filters of the most selective
+property) and a residual part, which fetchPage() evaluates in Python
+over a streamed query iterator.
+
+Filters are dicts with "field", "operator" and "value" keys, as built
+by ConferenceApi._formatFilters().
+
+Plans are cached per canonical filter list (see canonical()) in an
+in-process LRU of MAX_CACHED_PLANS plans and in memcache. cachedResult()
+caches serialized result pages in memcache, tagged with the generation
+number of their kind; writers bump it with bumpGeneration() to
+invalidate all cached pages at once. A generation is the time of its
+bump in milliseconds, so it is never reused after an eviction, and pages
+computed within RESULT_SETTLE_TIME seconds of a bump are not cached, as
+eventually consistent queries may not see the write yet. On a miss only
+the request holding a short memcache lock recomputes the page; the
+others serve the stale page, if there is one, or wait for the new one.
+
+recordPlan() counts how often each plan shape (ancestor, equality
+fields, inequality field, sort orders, projection) runs; getPlanStats()
+feeds them to indexadvisor.py, which derives the indexes the plans need.
+
+"""
+
+import collections
+import datetime
+import hashlib
+import logging
+import operator
+import threading
+import time
+
+from google.appengine.api import memcache
+
+MEMCACHE_STATS_KEY = "QUERY_STATS_%s"
+STATS_CACHE_TIME = 3600         # seconds
+STATS_SAMPLE_SIZE = 500
+DEFAULT_RANGE_SELECTIVITY = 1.0 / 3
+BATCH_SIZE = 100
+MEMCACHE_PLAN_KEY = "QUERY_PLAN_%s_%s"
+PLAN_CACHE_TIME = 300           # seconds
+MAX_CACHED_PLANS = 1000         # in-process LRU size
+MEMCACHE_GENERATION_KEY = "QUERY_GENERATION_%s"
+MEMCACHE_RESULT_KEY = "QUERY_RESULT_%s_%s"
+MEMCACHE_RESULT_LOCK_KEY = "QUERY_RESULT_LOCK_%s"
+RESULT_CACHE_TIME = 60          # seconds
+RESULT_SETTLE_TIME = 5          # seconds after a bump not to cache results
+RESULT_LOCK_TIME = 10           # seconds
+RESULT_WAIT_TIME = 1.0          # seconds
+RESULT_POLL_INTERVAL = 0.05     # seconds
+MEMCACHE_PLAN_SHAPES_KEY = "QUERY_PLAN_SHAPES_%s"
+MEMCACHE_PLAN_COUNT_PREFIX = "QUERY_PLAN_COUNT_"
+
+# in-process LRU plan cache: key -> (expiry, plan)
+_plans = collections.OrderedDict()
+_plans_lock = threading.Lock()
+_known_shapes = set()
+
+OPERATOR_FUNCS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+def _toNumber(value):
+    """Map a filter or property value onto a number, or None."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, long, float)):
+        return value
+    if isinstance(value, datetime.datetime):
+        return (value - datetime.datetime(1970, 1, 1)).total_seconds()
+    if isinstance(value, datetime.date):
+        return value.toordinal()
+    if isinstance(value, datetime.time):
+        return value.hour * 3600 + value.minute * 60 + value.second
+    return None
+
+
+def _values(entity, field):
+    """Return the values of field on entity as a list."""
+    value = getattr(entity, field, None)
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def getFieldStats(model, fields):
+    """Return {field: stats} for model, sampled and cached in memcache.
+
+    stats is a dict with the number of sampled values ("count"), the
+    number of distinct values ("distinct") and, for numeric-like
+    fields, the smallest and largest value ("min", "max").
+    """
+    cache_key = MEMCACHE_STATS_KEY % model._get_kind()
+    stats = memcache.get(cache_key)
+    if stats is not None and all(field in stats for field in fields):
+        return stats
+
+    sample = model.query().fetch(STATS_SAMPLE_SIZE)
+    stats = {}
+    for field in fields:
+        values = [value for entity in sample
+                  for value in _values(entity, field) if value is not None]
+        numbers = [number for number in map(_toNumber, values)
+                   if number is not None]
+        stats[field] = {
+            'count': len(values),
+            'distinct': len(set(values)),
+            'min': min(numbers) if numbers else None,
+            'max': max(numbers) if numbers else None,
+        }
+    memcache.set(cache_key, stats, time=STATS_CACHE_TIME)
+    return stats
+
+
+def selectivity(filters, stats):
+    """Estimate the fraction of entities matching all filters on a field."""
+    fraction = 1.0
+    for filtr in filters:
+        op = filtr["operator"]
+        distinct = stats.get('distinct') if stats else None
+        if op == '=':
+            estimate = 1.0 / distinct if distinct else 0.1
+        elif op == '!=':
+            estimate = 1.0 - 1.0 / distinct if distinct else 0.9
+        else:
+            estimate = DEFAULT_RANGE_SELECTIVITY
+            value = _toNumber(filtr["value"])
+            low = stats.get('min') if stats else None
+            high = stats.get('max') if stats else None
+            if value is not None and low is not None and high > low:
+                position = float(value - low) / (high - low)
+                position = min(max(position, 0.0), 1.0)
+                if op in ('<', '<='):
+                    estimate = position
+                else:
+                    estimate = 1.0 - position
+        fraction *= estimate
+    return fraction
+
+
+def plan(filters, getStats):
+    """Split filters into datastore and in-memory parts.
+
+    Returns (inequality_field, pushed_filters, residual_filters).
+    getStats(fields) is only called when more than one property carries
+    an inequality filter. A != filter is run by the datastore as two
+    merged queries, so it is only pushed down when it is the sole
+    inequality.
+    """
+    by_field = {}
+    for filtr in filters:
+        if filtr["operator"] != '=':
+            by_field.setdefault(filtr["field"], []).append(filtr)
+    equalities = [filtr for filtr in filters if filtr["operator"] == '=']
+
+    if len(by_field) <= 1:
+        inequality_field = by_field.keys()[0] if by_field else None
+        return inequality_field, filters, []
+
+    candidates = [field for field, field_filters in by_field.items()
+                  if any(filtr["operator"] != '!=' for filtr in field_filters)]
+    if not candidates:
+        candidates = by_field.keys()
+    if len(candidates) == 1:
+        inequality_field = candidates[0]
+    else:
+        stats = getStats(candidates)
+        inequality_field = min(
+            candidates,
+            key=lambda field: selectivity(by_field[field], stats.get(field)))
+
+    pushed = equalities + by_field[inequality_field]
+    residual = [filtr for field, field_filters in by_field.items()
+                if field != inequality_field for filtr in field_filters]
+    return inequality_field, pushed, residual
+
+
+def _compare(func, value, target):
+    """Apply an operator func in datastore order, where None sorts below
+    every other value; Python 2 can't order None and dates or times."""
+    if value is None or target is None:
+        value, target = value is not None, target is not None
+    return func(value, target)
+
+
+def matches(entity, filters):
+    """Return True if entity satisfies all filters.
+
+    Like the datastore, a repeated property matches if any of its values
+    does.
+    """
+    for filtr in filters:
+        func = OPERATOR_FUNCS[filtr["operator"]]
+        if not any(_compare(func, value, filtr["value"])
+                   for value in _values(entity, filtr["field"])):
+            return False
+    return True
+
+
+def fetchPage(query, residual, page_size=None, start_cursor=None):
+    """Stream query and keep the entities that match the residual filters.
+
+    Returns (results, next_cursor, more) like Query.fetch_page(); without
+    page_size all matching entities are returned.
+    """
+    produce_cursors = bool(page_size)
+    it = query.iter(start_cursor=start_cursor,
+                    produce_cursors=produce_cursors,
+                    batch_size=BATCH_SIZE)
+    results = []
+    for entity in it:
+        if matches(entity, residual):
+            results.append(entity)
+            if page_size and len(results) >= page_size:
+                break
+    if page_size and len(results) >= page_size and it.probably_has_next():
+        return results, it.cursor_after(), True
+    return results, None, False
+
+
+def canonical(filters):
+    """Return filters sorted, without duplicates, so that equivalent
+    filter lists share one plan and one result cache entry."""
+    unique = {}
+    for filtr in filters:
+        unique[(filtr["field"], filtr["operator"], repr(filtr["value"]))] = (
+            filtr)
+    return [unique[key] for key in sorted(unique)]
+
+
+def _hash(value):
+    return hashlib.sha1(repr(value)).hexdigest()
+
+
+def cachedPlan(model, filters, getStats):
+    """Return plan() of the canonical filters, cached in the instance and
+    in memcache for PLAN_CACHE_TIME seconds."""
+    filters = canonical(filters)
+    cache_key = MEMCACHE_PLAN_KEY % (model._get_kind(), _hash(
+        [(f["field"], f["operator"], repr(f["value"])) for f in filters]))
+    now = time.time()
+    with _plans_lock:
+        cached = _plans.pop(cache_key, None)
+        if cached and cached[0] > now:
+            _plans[cache_key] = cached
+            return cached[1]
+    result = memcache.get(cache_key)
+    if result is None:
+        result = plan(filters, getStats)
+        memcache.set(cache_key, result, time=PLAN_CACHE_TIME)
+    with _plans_lock:
+        _plans[cache_key] = (now + PLAN_CACHE_TIME, result)
+        while len(_plans) > MAX_CACHED_PLANS:
+            _plans.popitem(last=False)
+    return result
+
+
+def _now():
+    return int(time.time() * 1000)
+
+
+def getGeneration(kind):
+    """Return the current result cache generation of kind."""
+    key = MEMCACHE_GENERATION_KEY % kind
+    generation = memcache.get(key)
+    if generation is None:
+        # evicted: start a new generation, as if bumped now
+        memcache.add(key, _now())
+        generation = memcache.get(key) or _now()
+    return generation
+
+
+def bumpGeneration(kind):
+    """Invalidate all cached result pages of kind."""
+    key = MEMCACHE_GENERATION_KEY % kind
+    generation = _now()
+    # keep the generation increasing within the same millisecond
+    if generation <= (memcache.get(key) or 0):
+        memcache.incr(key)
+    else:
+        memcache.set(key, generation)
+
+
+def resultKey(kind, filters, *params):
+    """Return the memcache key of a result page of the canonical filters
+    and further request parameters (page size, token, view, ...)."""
+    return MEMCACHE_RESULT_KEY % (kind, _hash((
+        [(f["field"], f["operator"], repr(f["value"]))
+         for f in canonical(filters)],
+        params)))
+
+
+def cachedResult(kind, key, compute):
+    """Return the cached result under key, computing it with compute()
+    if the cached one is missing or of an older generation of kind.
+
+    Results must be picklable, e.g. serialized messages.
+    """
+    generation = getGeneration(kind)
+    cached = memcache.get(key)
+    if cached is not None and cached[0] == generation:
+        return cached[1]
+
+    lock_key = MEMCACHE_RESULT_LOCK_KEY % key
+    if not memcache.add(lock_key, 1, time=RESULT_LOCK_TIME):
+        # another request is recomputing: serve the stale result, or
+        # wait a little for the new one
+        if cached is not None:
+            return cached[1]
+        deadline = time.time() + RESULT_WAIT_TIME
+        while time.time() < deadline:
+            time.sleep(RESULT_POLL_INTERVAL)
+            cached = memcache.get(key)
+            if cached is not None and cached[0] == generation:
+                return cached[1]
+        return compute()
+    try:
+        result = compute()
+        if _now() - generation >= RESULT_SETTLE_TIME * 1000:
+            memcache.set(key, (generation, result), time=RESULT_CACHE_TIME)
+    finally:
+        memcache.delete(lock_key)
+    return result
+
+
+def recordPlan(kind, pushed, inequality_field, orders, projection=None,
+               ancestor=False, scope=()):
+    """Count a run of the plan shape and log shapes as they get hot.
+
+    ancestor tells if the query has an ancestor; scope lists the fields
+    the query was filtered on by equality before the plan was applied.
+    """
+    shape = {
+        'kind': kind,
+        'ancestor': bool(ancestor),
+        'equalities': sorted(set(f["field"] for f in pushed
+                                 if f["operator"] == '=') | set(scope)),
+        'inequality': inequality_field,
+        'orders': list(orders),
+        'projection': sorted(projection) if projection else [],
+    }
+    shape_id = _hash(sorted(shape.items()))
+    count = memcache.incr(MEMCACHE_PLAN_COUNT_PREFIX + shape_id,
+                          initial_value=0)
+    if count and count & (count - 1) == 0 and count >= 16:
+        logging.info("hot query plan (%d runs): %s" % (count, shape))
+    if shape_id in _known_shapes:
+        return
+    client = memcache.Client()
+    shapes_key = MEMCACHE_PLAN_SHAPES_KEY % kind
+    for _ in range(3):
+        shapes = client.gets(shapes_key)
+        if shapes is not None and shape_id in shapes:
+            break
+        updated = dict(shapes or {})
+        updated[shape_id] = shape
+        if shapes is None:
+            if client.add(shapes_key, updated):
+                break
+        elif client.cas(shapes_key, updated):
+            break
+    _known_shapes.add(shape_id)
+
+
+def getPlanStats(kind):
+    """Return the recorded plan shapes of kind with their run counts,
+    most frequent first."""
+    shapes = memcache.get(MEMCACHE_PLAN_SHAPES_KEY % kind) or {}
+    counts = memcache.get_multi(shapes.keys(),
+                                key_prefix=MEMCACHE_PLAN_COUNT_PREFIX)
+    stats = []
+    for shape_id, shape in shapes.items():
+        entry = dict(shape)
+        entry['count'] = int(counts.get(shape_id) or 0)
+        stats.append(entry)
+    return sorted(stats, key=lambda entry: -entry['count'])
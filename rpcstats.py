@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+"""
+rpcstats.py -- per-request RPC counts, phase timings and slow request logs
+
+install() adds apiproxy hooks that count the datastore, memcache,
+urlfetch and taskqueue calls of the current request by category and
+add up their time. Middleware wraps a WSGI application (the endpoints
+API server and main.app) so every request is recorded; phase() times a
+named part of a request, e.g. the speaker fan-out of session forms.
+
+Requests slower than SLOW_REQUEST_MS are logged as one JSON line. Per
+request name (endpoint method or handler path) the numbers are added to
+memcache counters, which getStats() returns for /_admin/stats.
+
+"""
+
+import json
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+SLOW_REQUEST_MS = 500
+MEMCACHE_STATS_PREFIX = "RPCSTATS_"
+MEMCACHE_NAMES_KEY = "RPCSTATS_NAMES"
+
+# (service, call) -> category; other calls of a service count as service
+CATEGORIES = {
+    ('datastore_v3', 'Get'): 'datastore.get',
+    ('datastore_v3', 'RunQuery'): 'datastore.query',
+    ('datastore_v3', 'Next'): 'datastore.query',
+    ('datastore_v3', 'Put'): 'datastore.put',
+    ('datastore_v3', 'Delete'): 'datastore.delete',
+    ('datastore_v3', 'BeginTransaction'): 'datastore.txn',
+    ('datastore_v3', 'Commit'): 'datastore.txn',
+    ('datastore_v3', 'Rollback'): 'datastore.txn',
+    ('urlfetch', 'Fetch'): 'urlfetch',
+    ('taskqueue', 'Add'): 'taskqueue.add',
+    ('taskqueue', 'BulkAdd'): 'taskqueue.add',
+}
+
+_local = threading.local()
+_installed = []
+_known_names = set()
+
+
+class Recorder(object):
+    """RPC counts and phase timings of one request."""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.rpcs = {}
+        self.rpcMs = 0.0
+        self.phases = {}
+        self.pending = {}
+
+    def elapsedMs(self):
+        return (time.time() - self.started) * 1000
+
+
+def _current():
+    return getattr(_local, 'recorder', None)
+
+
+def _category(service, call):
+    return CATEGORIES.get((service, call), service)
+
+
+def _preCall(service, call, request, response):
+    recorder = _current()
+    if recorder:
+        category = _category(service, call)
+        recorder.rpcs[category] = recorder.rpcs.get(category, 0) + 1
+        recorder.pending[id(response)] = time.time()
+
+
+def _postCall(service, call, request, response, *args):
+    recorder = _current()
+    if recorder:
+        started = recorder.pending.pop(id(response), None)
+        if started:
+            recorder.rpcMs += (time.time() - started) * 1000
+
+
+def install():
+    """Add the apiproxy hooks once per instance."""
+    if _installed:
+        return
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'rpcstats', _preCall)
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+        'rpcstats', _postCall)
+    _installed.append(True)
+
+
+class phase(object):
+    """Context manager adding the time of a block to a named phase."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        recorder = _current()
+        if recorder:
+            recorder.phases[self.name] = (
+                recorder.phases.get(self.name, 0.0) +
+                (time.time() - self.started) * 1000)
+        return False
+
+
+def _record(recorder):
+    """Log a slow request and add it to the memcache counters."""
+    totalMs = recorder.elapsedMs()
+    slow = totalMs >= SLOW_REQUEST_MS
+    if slow:
+        logging.warning(json.dumps({
+            'slowRequest': recorder.name,
+            'totalMs': round(totalMs, 1),
+            'rpcMs': round(recorder.rpcMs, 1),
+            'rpcs': recorder.rpcs,
+            'phasesMs': dict((name, round(ms, 1))
+                             for name, ms in recorder.phases.items()),
+        }, sort_keys=True))
+
+    offsets = {'calls': 1, 'totalMs': int(totalMs),
+               'rpcMs': int(recorder.rpcMs), 'slow': int(slow)}
+    for category, count in recorder.rpcs.items():
+        offsets['rpc.' + category] = count
+    for name, ms in recorder.phases.items():
+        offsets['phase.' + name] = int(ms)
+    memcache.offset_multi(offsets,
+                          key_prefix='%s%s|' % (MEMCACHE_STATS_PREFIX,
+                                                recorder.name),
+                          initial_value=0)
+    _rememberName(recorder.name, offsets.keys())
+
+
+def _rememberName(name, fields):
+    """Add name and its counter fields to the memcache index."""
+    if (name, tuple(sorted(fields))) in _known_names:
+        return
+    client = memcache.Client()
+    for _ in range(3):
+        names = client.gets(MEMCACHE_NAMES_KEY)
+        updated = dict(names or {})
+        updated[name] = sorted(set(updated.get(name, [])) | set(fields))
+        if names is None:
+            if client.add(MEMCACHE_NAMES_KEY, updated):
+                break
+        elif updated == names or client.cas(MEMCACHE_NAMES_KEY, updated):
+            break
+    _known_names.add((name, tuple(sorted(fields))))
+
+
+def _requestName(environ):
+    """Name a request by its endpoint method or its handler path."""
+    path = environ.get('PATH_INFO', '')
+    if path.startswith('/_ah/spi/'):
+        return path[len('/_ah/spi/'):]
+    return path
+
+
+class Middleware(object):
+    """WSGI middleware recording every request of an application."""
+
+    def __init__(self, app):
+        install()
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        recorder = Recorder(_requestName(environ))
+        _local.recorder = recorder
+        try:
+            # the response is built in full by the wrapped application
+            return list(self.app(environ, start_response))
+        finally:
+            _local.recorder = None
+            try:
+                _record(recorder)
+            except Exception:
+                logging.exception("rpcstats: recording %s failed"
+                    % recorder.name)
+
+
+def getStats():
+    """Return {request name: counters} with per-call averages."""
+    names = memcache.get(MEMCACHE_NAMES_KEY) or {}
+    stats = {}
+    for name, fields in sorted(names.items()):
+        counters = memcache.get_multi(
+            fields, key_prefix='%s%s|' % (MEMCACHE_STATS_PREFIX, name))
+        calls = int(counters.get('calls') or 0)
+        if not calls:
+            continue
+        entry = {'calls': calls, 'slow': int(counters.get('slow') or 0)}
+        for field in fields:
+            if field not in ('calls', 'slow'):
+                entry[field + 'PerCall'] = round(
+                    float(counters.get(field) or 0) / calls, 2)
+        stats[name] = entry
+    return stats
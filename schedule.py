@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+"""
+schedule.py -- per-conference session schedule snapshots
+
+A snapshot holds all sessions of a conference with their speakers
+resolved, sorted by date and start time, as a zlib-compressed
+protobuf-encoded SessionForms message. It is stored in memcache with a
+ScheduleSnapshot entity as fallback, and rebuilt by a coalesced
+/tasks/rebuild_schedule task whenever sessions of the conference change.
+
+In the flat session key layout the query of the sessions of a conference
+is eventually consistent, so the keys of written sessions are queued as
+pull tasks tagged with the conference, and the rebuild reads them along
+with the query results.
+
+"""
+
+import json
+import time
+import zlib
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+from protorpc import protobuf
+
+from models import ScheduleSnapshot
+from models import SessionForms
+
+import sessionkeys
+
+MEMCACHE_SCHEDULE_KEY = "SCHEDULE_%s"
+REBUILD_WINDOW = 2              # seconds
+PULL_QUEUE = "schedule-rebuilds"
+LEASE_SECONDS = 60
+LEASE_BATCH_SIZE = 1000
+
+
+def sortKey(sf):
+    """Sort SessionFormOuts by date, start time and name; unset first."""
+    return (sf.date not in (None, 'None'), sf.date,
+            sf.startTime not in (None, 'None'), sf.startTime,
+            sf.name)
+
+
+def encode(forms):
+    """Serialize SessionForms into a compressed blob."""
+    return zlib.compress(protobuf.encode_message(forms))
+
+
+def decode(blob):
+    """Deserialize a compressed blob into SessionForms."""
+    return protobuf.decode_message(SessionForms, zlib.decompress(blob))
+
+
+def _snapshotKey(conf_key):
+    return ndb.Key(ScheduleSnapshot, conf_key.urlsafe())
+
+
+def load(conf_key):
+    """Return the snapshot SessionForms of a conference, or None."""
+    cache_key = MEMCACHE_SCHEDULE_KEY % conf_key.urlsafe()
+    blob = memcache.get(cache_key)
+    if blob is None:
+        snapshot = _snapshotKey(conf_key).get()
+        if not snapshot:
+            return None
+        blob = snapshot.data
+        memcache.set(cache_key, blob)
+    return decode(blob)
+
+
+def store(conf_key, forms):
+    """Sort forms by time and store them as the conference snapshot."""
+    forms.items.sort(key=sortKey)
+    blob = encode(forms)
+    ScheduleSnapshot(key=_snapshotKey(conf_key), data=blob).put()
+    memcache.set(MEMCACHE_SCHEDULE_KEY % conf_key.urlsafe(), blob)
+    return forms
+
+
+def scheduleRebuild(conf_key, sess_keys=()):
+    """Enqueue a rebuild task, coalesced per conference and time window.
+
+    sess_keys are the keys of sessions just written, which the rebuild
+    reads in the flat layout.
+    """
+    wsck = conf_key.urlsafe()
+    if sess_keys and sessionkeys.getLayout() == sessionkeys.FLAT:
+        taskqueue.Queue(PULL_QUEUE).add(taskqueue.Task(
+            payload=json.dumps([key.urlsafe() for key in sess_keys]),
+            method='PULL', tag=wsck))
+    window = int(time.time() // REBUILD_WINDOW)
+    try:
+        taskqueue.add(
+            name='rebuild-schedule-%s-%d' % (wsck, window),
+            params={'websafeConferenceKey': wsck},
+            url='/tasks/rebuild_schedule',
+            countdown=REBUILD_WINDOW)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def rebuild(conf_key, build):
+    """Rebuild the snapshot of a conference by build(conf_key, sess_keys).
+
+    sess_keys are the written session keys queued for the conference;
+    their tasks are deleted once build succeeded, and released for the
+    retry of the rebuild task otherwise.
+    """
+    queue = taskqueue.Queue(PULL_QUEUE)
+    batches = []
+    while True:
+        tasks = queue.lease_tasks_by_tag(LEASE_SECONDS, LEASE_BATCH_SIZE,
+                                         tag=conf_key.urlsafe())
+        if tasks:
+            batches.append(tasks)
+        if len(tasks) < LEASE_BATCH_SIZE:
+            break
+    sess_keys = set(ndb.Key(urlsafe=wssk) for tasks in batches
+                    for task in tasks for wssk in json.loads(task.payload))
+    try:
+        forms = build(conf_key, list(sess_keys))
+    except Exception:
+        for tasks in batches:
+            for task in tasks:
+                queue.modify_task_lease(task, 0)
+        raise
+    for tasks in batches:
+        queue.delete_tasks(tasks)
+    return forms
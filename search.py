@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+
+"""
+search.py -- ranked full-text search over conferences and sessions
+
+Documents (Conference and Session entities) are tokenized with
+textutil into an inverted index kept in the datastore, one entity group
+per kind:
+
+  SearchTerm   postings of a term in one of TERM_SHARDS buckets, picked
+               by a hash of the websafe key: {websafe key: [tf,
+               document length]}
+  SearchDoc    term frequencies of a document, to diff on reindexing
+  SearchStats  number and total length of the indexed documents
+
+Changed documents are queued as pull tasks; a single worker, enqueued
+at most once per COALESCE_WINDOW, reindexes the leased documents in
+transactions of up to LEASE_BATCH_SIZE documents per kind and only
+rewrites the postings of terms whose frequency changed. search() reads
+all buckets of the query terms in one batch and scores the union of
+their postings with BM25; of a common term only the best
+MAX_POSTINGS_PER_TERM postings are ranked. Everything runs on the datastore and task queue, so it needs no
+external search service and runs on the development server and testbed
+stubs.
+
+The index lives under an entity group per kind and INDEX_VERSION; after
+changing its layout, bump INDEX_VERSION and rebuild the index with
+/tasks/reindex_search.
+
+"""
+
+import hashlib
+import heapq
+import json
+import logging
+import math
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import SearchDoc
+from models import SearchStats
+from models import SearchTerm
+
+import textutil
+
+PULL_QUEUE = "search-index"
+COALESCE_WINDOW = 5             # seconds
+LEASE_SECONDS = 60
+LEASE_BATCH_SIZE = 50           # documents per transaction
+MAX_TASK_RETRIES = 5
+MAX_RESULTS = 1000
+INDEX_VERSION = 2
+TERM_SHARDS = 32                # posting buckets per term
+MAX_POSTINGS_PER_TERM = 5000
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# indexed fields and their weights (a token counts weight times) per kind
+FIELDS = {
+    'Conference': [('name', 3), ('topics', 2), ('city', 2),
+                   ('description', 1)],
+    'Session': [('name', 3), ('highlight', 2), ('location', 1)],
+}
+
+STOPWORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in',
+    'is', 'it', 'of', 'on', 'or', 'the', 'this', 'to', 'with'])
+
+
+def tokenize(text):
+    """Return the indexable tokens of text."""
+    return [word for word in textutil.words(text) if word not in STOPWORDS]
+
+
+def _termFrequencies(entity):
+    """Return ({term: weighted frequency}, length) of an entity."""
+    tf = {}
+    for field, weight in FIELDS[entity.key.kind()]:
+        value = getattr(entity, field, None)
+        values = value if isinstance(value, list) else [value]
+        for text in values:
+            for token in tokenize(text):
+                tf[token] = tf.get(token, 0) + weight
+    return tf, sum(tf.values())
+
+
+def _groupKey(kind):
+    return ndb.Key('SearchIndex', '%s-v%d' % (kind, INDEX_VERSION))
+
+
+def _shardOf(wsk):
+    """Return the posting bucket of a document."""
+    return int(hashlib.md5(wsk).hexdigest(), 16) % TERM_SHARDS
+
+
+def _termKey(kind, term, shard):
+    return ndb.Key(SearchTerm, '%s#%d' % (term, shard),
+                   parent=_groupKey(kind))
+
+
+def _docKey(kind, wsk):
+    return ndb.Key(SearchDoc, wsk, parent=_groupKey(kind))
+
+
+def _statsKey(kind):
+    return ndb.Key(SearchStats, kind, parent=_groupKey(kind))
+
+
+@ndb.transactional()
+def _applyDocuments(kind, entities):
+    """Reindex entities ({websafe key: entity or None}) of one kind."""
+    wsks = entities.keys()
+    docs = ndb.get_multi([_docKey(kind, wsk) for wsk in wsks])
+    stats = _statsKey(kind).get() or SearchStats(key=_statsKey(kind))
+
+    # postings to set (or remove, for None) per (term, bucket)
+    changes = {}
+    new_docs = []
+    old_docs = []
+    for wsk, doc in zip(wsks, docs):
+        old_tf = doc.terms if doc else {}
+        entity = entities[wsk]
+        new_tf, length = _termFrequencies(entity) if entity else ({}, 0)
+        shard = _shardOf(wsk)
+        for term in set(old_tf) | set(new_tf):
+            if term in new_tf:
+                posting = [new_tf[term], length]
+            else:
+                posting = None
+            changes.setdefault((term, shard), {})[wsk] = posting
+        if doc:
+            stats.docCount -= 1
+            stats.totalLength -= doc.length
+        if entity:
+            stats.docCount += 1
+            stats.totalLength += length
+            new_docs.append(SearchDoc(key=_docKey(kind, wsk),
+                                      terms=new_tf, length=length))
+        elif doc:
+            old_docs.append(doc.key)
+
+    buckets = changes.keys()
+    entries = ndb.get_multi([_termKey(kind, *bucket) for bucket in buckets])
+    puts = []
+    deletes = []
+    for bucket, entry in zip(buckets, entries):
+        existed = entry is not None
+        if not existed:
+            entry = SearchTerm(key=_termKey(kind, *bucket), postings={})
+        for wsk, posting in changes[bucket].items():
+            if posting is None:
+                entry.postings.pop(wsk, None)
+            else:
+                entry.postings[wsk] = posting
+        if entry.postings:
+            puts.append(entry)
+        elif existed:
+            deletes.append(entry.key)
+    ndb.put_multi(puts + new_docs + [stats])
+    ndb.delete_multi(deletes + old_docs)
+
+
+def indexDocuments(keys):
+    """Reindex the entities of keys right away; missing entities are
+    removed from the index."""
+    by_kind = {}
+    for key, entity in zip(keys, ndb.get_multi(keys)):
+        by_kind.setdefault(key.kind(), {})[key.urlsafe()] = entity
+    for kind, entities in by_kind.items():
+        wsks = entities.keys()
+        for start in range(0, len(wsks), LEASE_BATCH_SIZE):
+            _applyDocuments(kind, dict((wsk, entities[wsk]) for wsk in
+                                       wsks[start:start + LEASE_BATCH_SIZE]))
+
+
+def enqueue(keys):
+    """Queue changed conferences or sessions for the index worker."""
+    if not keys:
+        return
+    taskqueue.Queue(PULL_QUEUE).add(taskqueue.Task(
+        payload=json.dumps([key.urlsafe() for key in keys]),
+        method='PULL'))
+    scheduleWorker()
+
+
+def scheduleWorker():
+    """Enqueue the worker, at most once per time window."""
+    window = int(time.time() // COALESCE_WINDOW)
+    try:
+        taskqueue.add(name='search-index-%d' % window,
+                      url='/tasks/index_search',
+                      countdown=COALESCE_WINDOW)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def processQueue():
+    """Lease queued changes and reindex each document once.
+
+    Returns the number of leased tasks and of reindexed documents.
+    """
+    queue = taskqueue.Queue(PULL_QUEUE)
+    tasks = queue.lease_tasks(LEASE_SECONDS, LEASE_BATCH_SIZE)
+    wsks = set()
+    for task in tasks:
+        wsks.update(json.loads(task.payload))
+    try:
+        indexDocuments([ndb.Key(urlsafe=wsk) for wsk in sorted(wsks)])
+        done = tasks
+    except Exception:
+        # released for the next run, unless failed too often already
+        logging.exception("processQueue: reindexing failed")
+        done = [task for task in tasks
+                if task.retry_count >= MAX_TASK_RETRIES]
+        for task in tasks:
+            if task.retry_count < MAX_TASK_RETRIES:
+                queue.modify_task_lease(task, 0)
+    if done:
+        queue.delete_tasks(done)
+    logging.info("processQueue: %d tasks, %d documents"
+        % (len(tasks), len(wsks)))
+    if len(done) < len(tasks) or len(tasks) >= LEASE_BATCH_SIZE:
+        scheduleWorker()
+    return len(tasks), len(wsks)
+
+
+def _score(tf, length, idf, avg_length):
+    return idf * tf * (BM25_K1 + 1) / (
+        tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length))
+
+
+def _readPostings(kind, terms, shards, postings, extra_keys=()):
+    """Add the postings of the given buckets of terms to postings
+    ({term: [postings dict]}), reading extra_keys in the same batch;
+    returns the entities of extra_keys."""
+    keys = [(term, _termKey(kind, term, shard))
+            for term in terms for shard in shards]
+    entries = ndb.get_multi(list(extra_keys) + [key for _, key in keys])
+    for (term, _), entry in zip(keys, entries[len(extra_keys):]):
+        if entry:
+            postings[term].append(entry.postings)
+    return entries[:len(extra_keys)]
+
+
+def search(kind, query, accept=None):
+    """Return [(websafe key, score)] of kind matching any query term,
+    best first; accept(wsk) may reject documents before ranking.
+
+    At most MAX_RESULTS documents are ranked.
+    """
+    terms = sorted(set(tokenize(query)))
+    if not terms:
+        return []
+    postings = dict((term, []) for term in terms)
+    stats, = _readPostings(kind, terms, range(TERM_SHARDS), postings,
+                           [_statsKey(kind)])
+    if not stats or not stats.docCount:
+        return []
+    avg_length = float(stats.totalLength) / stats.docCount or 1.0
+
+    scores = {}
+    for term in terms:
+        df = sum(len(bucket) for bucket in postings[term])
+        if not df:
+            continue
+        idf = math.log(1 + (stats.docCount - df + 0.5) / (df + 0.5))
+        matches = ((wsk, _score(tf, length, idf, avg_length))
+                   for bucket in postings[term]
+                   for wsk, (tf, length) in bucket.items()
+                   if not accept or accept(wsk))
+        # only the best postings of a common term are ranked
+        for wsk, score in heapq.nlargest(MAX_POSTINGS_PER_TERM, matches,
+                                         key=lambda match: match[1]):
+            scores[wsk] = scores.get(wsk, 0.0) + score
+    ranking = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+    return ranking[:MAX_RESULTS]
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+"""
+seats.py -- sharded seat counters for conference registration
+
+Instead of read-modify-writing the single Conference entity on every
+registration, the seats of a conference are split over NUM_SHARDS
+SeatShard entities, each in its own entity group. A registration
+reads all shards at once outside of its transaction and decrements one
+randomly picked shard with seats left, so concurrent registrations
+rarely collide and only that shard joins the transaction.
+Conference.seatsAvailable is kept eventually correct by
+reconcileSeats(), run from a coalesced task queue job; changes of
+maxAttendees are applied to the shards by adjustSeats().
+
+"""
+
+import random
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import SeatShard
+
+import queryengine
+
+# never lower this value once conferences have been sharded
+NUM_SHARDS = 20
+MEMCACHE_SEATS_KEY = "SEATS_AVAILABLE_%s"
+SEATS_CACHE_TIME = 60           # seconds
+RECONCILE_WINDOW = 10           # seconds
+
+
+def _shardKeys(conf_key):
+    """Return the keys of all seat shards of a conference."""
+    wsck = conf_key.urlsafe()
+    return [ndb.Key(SeatShard, '%s-%d' % (wsck, index))
+            for index in range(NUM_SHARDS)]
+
+
+def _splitSeats(seats):
+    """Split seats as evenly as possible over NUM_SHARDS shards."""
+    seats = max(seats or 0, 0)
+    return [seats // NUM_SHARDS + (1 if index < seats % NUM_SHARDS else 0)
+            for index in range(NUM_SHARDS)]
+
+
+def createShards(conf_key, seats):
+    """Create the seat shards of a new conference."""
+    ndb.put_multi([SeatShard(key=key, seatsAvailable=count)
+                   for key, count in zip(_shardKeys(conf_key),
+                                         _splitSeats(seats))])
+
+
+@ndb.transactional(xg=True)
+def _initShards(conf):
+    """Shard the seats of a conference created before sharding existed."""
+    keys = _shardKeys(conf.key)
+    if keys[0].get():
+        return
+    createShards(conf.key, conf.seatsAvailable)
+
+
+@ndb.non_transactional
+def _readShards(keys):
+    """Read shards outside of the current transaction, in one batch."""
+    return ndb.get_multi(keys)
+
+
+def _cacheKey(conf_key):
+    return MEMCACHE_SEATS_KEY % conf_key.urlsafe()
+
+
+def _adjustCachedSeats(conf_key, delta):
+    """Adjust the cached aggregate once the transaction has committed."""
+    def callback():
+        if delta < 0:
+            memcache.decr(_cacheKey(conf_key), -delta)
+        else:
+            memcache.incr(_cacheKey(conf_key), delta)
+    if ndb.in_transaction():
+        ndb.get_context().call_on_commit(callback)
+    else:
+        callback()
+
+
+def getSeatsAvailable(conf):
+    """Return the number of available seats of a conference.
+
+    The sum over all shards is cached in memcache for SEATS_CACHE_TIME
+    seconds; conferences without shards report their stored value.
+    """
+    cached = memcache.get(_cacheKey(conf.key))
+    if cached is not None:
+        return cached
+    shards = ndb.get_multi(_shardKeys(conf.key))
+    if not shards[0]:
+        return conf.seatsAvailable
+    total = sum(shard.seatsAvailable for shard in shards if shard)
+    memcache.add(_cacheKey(conf.key), total, time=SEATS_CACHE_TIME)
+    return total
+
+
+@ndb.transactional(xg=True)
+def reserveSeat(conf):
+    """Take one seat from a random shard; return False if sold out.
+
+    Only shards that had seats left when read outside of the transaction
+    are tried, one at a time, so the transaction normally reads a single
+    shard.
+    """
+    keys = _shardKeys(conf.key)
+    shards = _readShards(keys)
+    if shards[0]:
+        keys = [shard.key for shard in shards
+                if shard and shard.seatsAvailable > 0]
+    else:
+        _initShards(conf)
+    random.shuffle(keys)
+    for key in keys:
+        shard = key.get()
+        if shard and shard.seatsAvailable > 0:
+            shard.seatsAvailable -= 1
+            shard.put()
+            _adjustCachedSeats(conf.key, -1)
+            return True
+    return False
+
+
+@ndb.transactional(xg=True)
+def releaseSeat(conf):
+    """Give one seat back to a random shard."""
+    keys = _shardKeys(conf.key)
+    if not _readShards(keys[:1])[0]:
+        _initShards(conf)
+    shard = random.choice(keys).get()
+    shard.seatsAvailable += 1
+    shard.put()
+    _adjustCachedSeats(conf.key, 1)
+
+
+@ndb.transactional(xg=True)
+def adjustSeats(conf, delta):
+    """Add delta seats to the shards of a conference, or remove -delta
+    free seats; returns False if fewer seats than that are free.
+
+    Used when maxAttendees changes, so the registrations are kept.
+    """
+    if not delta:
+        return True
+    keys = _shardKeys(conf.key)
+    shards = ndb.get_multi(keys)
+    if not shards[0]:
+        # not sharded yet: shard the adjusted stored value
+        seats = (conf.seatsAvailable or 0) + delta
+        if seats < 0:
+            return False
+        createShards(conf.key, seats)
+        return True
+    if delta > 0:
+        for shard, count in zip(shards, _splitSeats(delta)):
+            shard.seatsAvailable += count
+    else:
+        if sum(shard.seatsAvailable for shard in shards) < -delta:
+            return False
+        remaining = -delta
+        for shard in shards:
+            taken = min(shard.seatsAvailable, remaining)
+            shard.seatsAvailable -= taken
+            remaining -= taken
+    ndb.put_multi(shards)
+    _adjustCachedSeats(conf.key, delta)
+    return True
+
+
+def reconcileSeats(conf_key):
+    """Write the sum of the seat shards back to Conference.seatsAvailable."""
+    shards = ndb.get_multi(_shardKeys(conf_key))
+    if not shards[0]:
+        return None
+    total = sum(shard.seatsAvailable for shard in shards if shard)
+
+    @ndb.transactional()
+    def _update():
+        conf = conf_key.get()
+        if conf and conf.seatsAvailable != total:
+            conf.seatsAvailable = total
+            conf.put()
+            # cached query results show the stored seat count
+            ndb.get_context().call_on_commit(
+                lambda: queryengine.bumpGeneration('Conference'))
+        return conf
+    return _update()
+
+
+def scheduleReconcile(conf_key):
+    """Enqueue a reconcile task, coalesced per conference and time window."""
+    wsck = conf_key.urlsafe()
+    window = int(time.time() // RECONCILE_WINDOW)
+    try:
+        taskqueue.add(
+            name='reconcile-seats-%s-%d' % (wsck, window),
+            params={'websafeConferenceKey': wsck},
+            url='/tasks/reconcile_seats',
+            countdown=RECONCILE_WINDOW)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+"""
+sessionkeys.py -- key layout of Session entities
+
+Sessions are stored in one of two key layouts, chosen by
+settings.SESSION_KEY_LAYOUT (or setLayout()):
+
+  ancestor  Session keys are children of their Conference key, which
+            is a child of the organizer's Profile. Sessions of a
+            conference are read by strongly consistent ancestor queries,
+            but all sessions, conferences and the profile of an organizer
+            share one entity group and its write rate of about one
+            commit per second; every session write also makes concurrent
+            transactions reading the group (e.g. registrations, which
+            read the conference) retry.
+  flat      Session keys are root keys and conferenceKey points to the
+            conference. Every session is an entity group of its own, but
+            queries of the sessions of a conference filter on
+            conferenceKey and are eventually consistent.
+
+Sessions carry conferenceKey in both layouts, and the API addresses a
+session by websafeConferenceKey and sessionId in both. migrate() moves
+the sessions of a conference into the configured layout under newly
+allocated ids and leaves a SessionMove behind per moved session, which
+get() follows for ids handed out before; until a conference is
+migrated, get() also finds its sessions under their old key.
+
+"""
+
+import logging
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Session
+from models import SessionMove
+from models import WishlistEntry
+
+import settings
+import userlists
+
+ANCESTOR = 'ancestor'
+FLAT = 'flat'
+LAYOUTS = (ANCESTOR, FLAT)
+MIGRATION_BATCH_SIZE = 100
+
+_layout = settings.SESSION_KEY_LAYOUT
+
+
+def getLayout():
+    """Return the configured key layout."""
+    return _layout
+
+
+def setLayout(layout):
+    """Replace the key layout; returns the previous one."""
+    global _layout
+    if layout not in LAYOUTS:
+        raise ValueError('Unknown session key layout: %s' % layout)
+    previous, _layout = _layout, layout
+    return previous
+
+
+def _otherLayout(layout):
+    return FLAT if layout == ANCESTOR else ANCESTOR
+
+
+def inLayout(sess_key, layout=None):
+    """Return True if sess_key is a key of the given (or configured)
+    layout."""
+    ancestor = (layout or _layout) == ANCESTOR
+    return (sess_key.parent() is not None) == ancestor
+
+
+def sessionKey(conf_key, sessionId, layout=None):
+    """Return the key of session sessionId of a conference."""
+    if (layout or _layout) == ANCESTOR:
+        return ndb.Key(Session, int(sessionId), parent=conf_key)
+    return ndb.Key(Session, int(sessionId))
+
+
+def _moveKey(sess_key):
+    return ndb.Key(SessionMove, sess_key.urlsafe())
+
+
+def allocateKeys(conf_key, count):
+    """Allocate the keys of count new sessions of a conference at once.
+
+    The two layouts allocate ids independently, so ids still naming a
+    session in the other layout, or a SessionMove of one, are skipped
+    and replaced; every id of a conference names one session only.
+    """
+    keys = []
+    while len(keys) < count:
+        size = count - len(keys)
+        if _layout == ANCESTOR:
+            first, last = Session.allocate_ids(size=size, parent=conf_key)
+        else:
+            first, last = Session.allocate_ids(size=size)
+        new_keys = [sessionKey(conf_key, s_id)
+                    for s_id in range(first, last + 1)]
+        old_keys = [sessionKey(conf_key, key.id(), _otherLayout(_layout))
+                    for key in new_keys]
+        found = ndb.get_multi(old_keys + [_moveKey(key) for key in old_keys])
+        keys.extend(key for key, sess, move in zip(
+                         new_keys, found[:size], found[size:])
+                    if not sess and not move)
+    return keys
+
+
+def conferenceOf(sess):
+    """Return the conference key of a session in either layout.
+
+    The key parent is used where there is one, so projected sessions of
+    the ancestor layout need not include conferenceKey.
+    """
+    return sess.key.parent() or sess.conferenceKey
+
+
+def conferencesOf(sess_keys):
+    """Return the set of conference keys of session keys; sessions in the
+    flat layout are read for it."""
+    conf_keys = set(key.parent() for key in sess_keys if key.parent())
+    flat_keys = [key for key in sess_keys if not key.parent()]
+    conf_keys.update(sess.conferenceKey
+                     for sess in ndb.get_multi(flat_keys)
+                     if sess and sess.conferenceKey)
+    return conf_keys
+
+
+def query(conf_key, layout=None):
+    """Return the query of the sessions of a conference; in the flat
+    layout it is eventually consistent."""
+    if (layout or _layout) == ANCESTOR:
+        return Session.query(ancestor=conf_key)
+    return Session.query(Session.conferenceKey == conf_key)
+
+
+def scopeFields(layout=None):
+    """Return the equality fields query() filters on, for recording
+    query plans; ancestor queries are recognized by their ancestor."""
+    if (layout or _layout) == ANCESTOR:
+        return []
+    return ['conferenceKey']
+
+
+def _belongsTo(sess, conf_key):
+    return sess is not None and conferenceOf(sess) == conf_key
+
+
+def fetchAll(conf_key, sess_keys=()):
+    """Return all sessions of a conference.
+
+    In the flat layout the keys found by query() are read together with
+    sess_keys, the keys of sessions just written, which the query may
+    miss yet; the sessions themselves are read strongly consistent, and
+    the ones no longer in the conference are dropped.
+    """
+    if _layout == ANCESTOR:
+        return query(conf_key).fetch()
+    keys = set(query(conf_key).fetch(keys_only=True))
+    keys.update(sess_keys)
+    return [sess for sess in ndb.get_multi(list(keys))
+            if _belongsTo(sess, conf_key)]
+
+
+def getMulti(conf_key, sessionIds):
+    """Return the sessions of a conference by id in the configured
+    layout, None for missing ones."""
+    sessions = ndb.get_multi([sessionKey(conf_key, sessionId)
+                              for sessionId in sessionIds])
+    return [sess if _belongsTo(sess, conf_key) else None
+            for sess in sessions]
+
+
+def get(conf_key, sessionId):
+    """Return session sessionId of a conference, or None.
+
+    Moved sessions are found through their SessionMove, and sessions not
+    moved into the configured layout yet under their old key, which only
+    costs a read when the session is not found otherwise. allocateKeys()
+    never hands out an id of either, so at most one of them exists.
+    """
+    old_key = sessionKey(conf_key, sessionId, _otherLayout(_layout))
+    move, sess = ndb.get_multi([_moveKey(old_key),
+                                sessionKey(conf_key, sessionId)])
+    if move:
+        target = move.target.get()
+        if _belongsTo(target, conf_key):
+            return target
+    if not _belongsTo(sess, conf_key):
+        sess = old_key.get()
+    return sess if _belongsTo(sess, conf_key) else None
+
+
+@ndb.transactional(xg=True)
+def _move(old_key, new_key, conf_key):
+    """Copy a session to new_key, store its SessionMove and delete it,
+    in one transaction; returns the key the session is found under now,
+    or None if it is gone."""
+    move_key = _moveKey(old_key)
+    sess, move = ndb.get_multi([old_key, move_key])
+    if move:
+        # left behind by an interrupted run
+        if sess:
+            old_key.delete()
+        return move.target
+    if not sess:
+        return None
+    data = sess.to_dict()
+    data['conferenceKey'] = conf_key
+    ndb.put_multi([Session(key=new_key, **data),
+                   SessionMove(key=move_key, target=new_key)])
+    old_key.delete()
+    return new_key
+
+
+def migrate(conf_key):
+    """Move the sessions of a conference into the configured layout.
+
+    Each session is moved in a transaction of its own, which reads it,
+    copies it to a new key, stores a SessionMove for its old key and
+    deletes it, so concurrent updates of the session are not lost.
+    Returns [(old key, new key)] of the moved sessions.
+    """
+    # sessions of the ancestor layout written since conferenceKey was
+    # added are found by both queries
+    old_keys = []
+    for layout in LAYOUTS:
+        for key in query(conf_key, layout).fetch(keys_only=True):
+            if not inLayout(key) and key not in old_keys:
+                old_keys.append(key)
+    if not old_keys:
+        return []
+    moved = []
+    # ids allocated for sessions moved by an interrupted run or deleted
+    # meanwhile are left unused
+    for old_key, new_key in zip(old_keys,
+                                allocateKeys(conf_key, len(old_keys))):
+        target = _move(old_key, new_key, conf_key)
+        if target:
+            moved.append((old_key, target))
+    return moved
+
+
+def migrateWishlistBatch(websafeCursor=None):
+    """Point the wishlist entries of moved sessions at their new keys,
+    for one batch of entries.
+
+    Returns the cursor of the next batch, or None when all entries are
+    done.
+    """
+    cursor = Cursor(urlsafe=websafeCursor) if websafeCursor else None
+    entry_keys, next_cursor, more = WishlistEntry.query().fetch_page(
+        MIGRATION_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+    moves = ndb.get_multi([ndb.Key(SessionMove, key.string_id())
+                           for key in entry_keys])
+    entries = [WishlistEntry(key=userlists.entryKey(
+                   WishlistEntry, key.parent(), move.target.urlsafe()))
+               for key, move in zip(entry_keys, moves) if move]
+    ndb.put_multi(entries)
+    ndb.delete_multi([key for key, move in zip(entry_keys, moves) if move])
+    logging.info("migrateWishlistBatch: %d of %d entries moved"
+        % (len(entries), len(entry_keys)))
+    if more and next_cursor:
+        return next_cursor.urlsafe()
@@ -14,3 +14,14 @@ created/forked from conference.py by wesc on 2014 may 24
 # Console or Cloud Console.
 WEB_CLIENT_ID ='637967746861-qjmp4liifu9crlb0gjt1iktoe4fagdsj.apps.googleusercontent.com'
 # WEB_CLIENT_ID = '660563293836-v665ko8ob093brk45h09lhittbg9ogh6.apps.googleusercontent.com'
+
+# Key layout of Session entities, see sessionkeys.py: 'ancestor' stores
+# sessions as children of their conference, 'flat' as root entities with
+# a conferenceKey property. Run /tasks/migrate_session_keys after changing
+# it to move existing sessions.
+SESSION_KEY_LAYOUT = 'ancestor'
+
+# Transport of outbound notification email, see notifications.py: 'mail'
+# sends it with the App Engine mail API, 'logging' only logs it, e.g. on
+# a development server.
+NOTIFICATION_TRANSPORT = 'mail'
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+"""
+textutil.py -- text normalization shared by the name and search indexes
+
+normalize() folds case and accents, drops apostrophes and turns other
+punctuation into spaces, so "O'Brien-Smith" and "obrien smith" index
+alike; the same normalization is applied to indexed text and to user
+input.
+
+"""
+
+import re
+import unicodedata
+
+_NON_WORD = re.compile(r'[^0-9a-z]+')
+
+
+def normalize(text):
+    """Return text lower-cased, without accents and punctuation, with
+    words separated by single spaces."""
+    if not text:
+        return u''
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'replace')
+    text = u''.join(char for char in unicodedata.normalize('NFKD', text)
+                    if not unicodedata.combining(char))
+    text = text.lower().replace(u"'", u'')
+    return _NON_WORD.sub(u' ', text).strip()
+
+
+def words(text):
+    """Return the normalized words of text."""
+    return normalize(text).split()
+
+
+def prefixTokens(text):
+    """Return the sorted tokens a name is found by in a prefix search:
+    each of its words and the whole normalized name, so that both
+    "smi" and "john sm" find "John Smith"."""
+    name = normalize(text)
+    return sorted(set(name.split()) | set([name] if name else []))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""
+timetable.py -- overlap detection and schedule building for sessions
+
+A Timetable holds the sessions that have a date and a start time as
+parallel arrays of start and end minutes, sorted by start. Overlapping
+sessions are found with a single sweep over these arrays, keeping a
+heap of the sessions still running, and a conflict-free schedule with
+the largest number of sessions is picked greedily by earliest end.
+
+Sessions are half-open intervals [start, start + durationInMins); a
+session without duration lasts zero minutes. Positions returned by a
+Timetable index the list of sessions it was built from.
+
+"""
+
+import datetime
+import heapq
+from array import array
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def _minutes(date_ordinal, hour, minute):
+    return date_ordinal * MINUTES_PER_DAY + hour * 60 + minute
+
+
+def _sessionIntervals(sessions):
+    """Yield (position, start, end) of Session entities with a time."""
+    for position, sess in enumerate(sessions):
+        if sess.date and sess.startTime:
+            start = _minutes(sess.date.toordinal(),
+                             sess.startTime.hour, sess.startTime.minute)
+            yield position, start, start + (sess.durationInMins or 0)
+
+
+def _formIntervals(forms):
+    """Yield (position, start, end) of SessionFormOuts with a time.
+
+    Dates and times are the "YYYY-MM-DD" and "HH:MM:SS" strings (or
+    "None") written by ConferenceApi._copySessionToForm().
+    """
+    for position, sf in enumerate(forms):
+        if sf.date in (None, 'None') or sf.startTime in (None, 'None'):
+            continue
+        year, month, day = sf.date.split('-')
+        date = datetime.date(int(year), int(month), int(day))
+        start = _minutes(date.toordinal(),
+                         int(sf.startTime[0:2]), int(sf.startTime[3:5]))
+        yield position, start, start + (sf.durationInMins or 0)
+
+
+class Timetable(object):
+    """Sessions with a time as arrays of start and end minutes."""
+
+    def __init__(self, count, intervals):
+        rows = sorted(intervals, key=lambda row: (row[1], row[2]))
+        self.positions = array('l', [row[0] for row in rows])
+        self.starts = array('l', [row[1] for row in rows])
+        self.ends = array('l', [row[2] for row in rows])
+        timed = set(self.positions)
+        self.untimed = [position for position in xrange(count)
+                        if position not in timed]
+
+    def conflicts(self, limit=None):
+        """Return (pairs, count) of overlapping sessions.
+
+        pairs holds at most limit (earlier, later) position pairs in
+        order of the later session's start; count is the total number
+        of overlapping pairs.
+        """
+        starts, ends, positions = self.starts, self.ends, self.positions
+        running = []            # heap of (end, index) of running sessions
+        pairs = []
+        count = 0
+        for i in xrange(len(starts)):
+            start = starts[i]
+            while running and running[0][0] <= start:
+                heapq.heappop(running)
+            count += len(running)
+            if limit is None or len(pairs) < limit:
+                for end, j in sorted(running, key=lambda item: item[1]):
+                    if limit is not None and len(pairs) >= limit:
+                        break
+                    pairs.append((positions[j], positions[i]))
+            if ends[i] > start:
+                heapq.heappush(running, (ends[i], i))
+        return pairs, count
+
+    def schedule(self):
+        """Return the positions of a largest conflict-free set of
+        sessions, in order of time."""
+        starts, ends = self.starts, self.ends
+        chosen = []
+        last_end = None
+        for i in sorted(xrange(len(starts)), key=ends.__getitem__):
+            if last_end is None or starts[i] >= last_end:
+                chosen.append(self.positions[i])
+                last_end = ends[i]
+        return chosen
+
+
+def fromSessions(sessions):
+    """Return the Timetable of a list of Session entities."""
+    return Timetable(len(sessions), _sessionIntervals(sessions))
+
+
+def fromForms(forms):
+    """Return the Timetable of a list of SessionFormOuts."""
+    return Timetable(len(forms), _formIntervals(forms))
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""
+userlists.py -- conferences to attend and session wishlists of users
+
+Every entry is a small child entity of the user's Profile (Attendance
+or WishlistEntry) whose string id is the websafe key of the conference
+or session. Membership is a single get by key, adding or removing an
+entry writes only that entry, and listing is a keys-only ancestor query
+paged by cursor, so the Profile entity no longer grows with its lists.
+
+Profiles written before carry their entries in the repeated
+conferenceKeysToAttend / sessionKeysOnWishlist properties; migrate()
+moves them to child entities, and migrateBatch() does so for all
+profiles.
+
+"""
+
+import logging
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Attendance
+from models import Profile
+from models import WishlistEntry
+
+MIGRATION_BATCH_SIZE = 100
+
+# legacy Profile list property of each entry kind
+LEGACY_FIELDS = {
+    Attendance: 'conferenceKeysToAttend',
+    WishlistEntry: 'sessionKeysOnWishlist',
+}
+
+
+def entryKey(model, p_key, websafeKey):
+    """Return the key of the entry for websafeKey in a user's list."""
+    return ndb.Key(model, websafeKey, parent=p_key)
+
+
+def contains(model, p_key, websafeKey):
+    """Return True if websafeKey is in the user's list."""
+    return entryKey(model, p_key, websafeKey).get() is not None
+
+
+def add(model, p_key, websafeKey):
+    """Add websafeKey to the user's list."""
+    model(key=entryKey(model, p_key, websafeKey)).put()
+
+
+def remove(model, p_key, websafeKey):
+    """Remove websafeKey from the user's list."""
+    entryKey(model, p_key, websafeKey).delete()
+
+
+def query(model, p_key):
+    """Return the ancestor query of the user's list entries."""
+    return model.query(ancestor=p_key)
+
+
+def toKeys(entry_keys):
+    """Map entry keys onto the keys of the listed entities."""
+    return [ndb.Key(urlsafe=key.string_id()) for key in entry_keys]
+
+
+def hasLegacyEntries(prof):
+    """Return True if prof still holds entries in its list properties."""
+    return any(getattr(prof, field) for field in LEGACY_FIELDS.values())
+
+
+@ndb.transactional()
+def migrate(p_key):
+    """Move the legacy list entries of a profile to child entities.
+
+    Returns the number of moved entries.
+    """
+    prof = p_key.get()
+    if not prof or not hasLegacyEntries(prof):
+        return 0
+    entries = []
+    for model, field in LEGACY_FIELDS.items():
+        entries.extend(model(key=entryKey(model, p_key, websafeKey))
+                       for websafeKey in set(getattr(prof, field)))
+        setattr(prof, field, [])
+    ndb.put_multi(entries + [prof])
+    return len(entries)
+
+
+def migrateBatch(websafeCursor=None):
+    """Migrate the list entries of one batch of profiles.
+
+    Returns the cursor of the next batch, or None when all profiles
+    are done.
+    """
+    cursor = Cursor(urlsafe=websafeCursor) if websafeCursor else None
+    profiles, next_cursor, more = Profile.query().fetch_page(
+        MIGRATION_BATCH_SIZE, start_cursor=cursor)
+    moved = sum(migrate(prof.key) for prof in profiles
+                if hasLegacyEntries(prof))
+    logging.info("migrateBatch: %d entries of %d profiles moved"
+        % (moved, len(profiles)))
+    if more and next_cursor:
+        return next_cursor.urlsafe()
@@ -1,12 +1,117 @@
+import collections
+import hashlib
 import json
 import os
+import random
+import threading
 import time
 import uuid
 import endpoints
 
+from google.appengine.api import memcache
 from google.appengine.api import urlfetch
 from models import Profile
 
+import rpcstats
+
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
+TOKENINFO_DEADLINE = 2          # seconds per fetch
+TOKENINFO_ATTEMPTS = 3
+BACKOFF_BASE = 0.05             # seconds
+BACKOFF_CAP = 0.4               # seconds
+MEMCACHE_TOKEN_KEY = "TOKEN_%s"
+TOKEN_CACHE_SIZE = 1000
+TOKEN_CACHE_TIME = 300          # seconds, if the token has no expiry
+
+
+class _TokenCache(object):
+    """Small thread-safe in-process LRU of token hash -> (user_id, expiry)."""
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[1] <= time.time():
+                return None
+            self.entries[key] = entry
+            return entry[0]
+
+    def set(self, key, user_id, expiry):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (user_id, expiry)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+_token_cache = _TokenCache(TOKEN_CACHE_SIZE)
+
+
+def tokeninfoVerifier(token, token_type):
+    """Verify token at the Google tokeninfo endpoint; return its info dict.
+
+    Failed fetches are retried after a short, jittered and capped backoff
+    instead of sleeping for whole seconds; an empty dict is returned if
+    the token cannot be verified.
+    """
+    for attempt in range(TOKENINFO_ATTEMPTS):
+        if attempt:
+            time.sleep(random.uniform(0, min(BACKOFF_CAP,
+                                             BACKOFF_BASE * 2 ** attempt)))
+        try:
+            resp = urlfetch.fetch(TOKENINFO_URL % (token_type, token),
+                                  deadline=TOKENINFO_DEADLINE)
+        except urlfetch.Error:
+            continue
+        if resp.status_code == 200:
+            return json.loads(resp.content)
+        elif resp.status_code == 400 and 'invalid_token' in resp.content:
+            if token_type == 'access_token':
+                break
+            token_type = 'access_token'
+    return {}
+
+_token_verifier = tokeninfoVerifier
+
+
+def setTokenVerifier(verifier):
+    """Replace the token verifier, e.g. by a local stub in tests.
+
+    verifier(token, token_type) returns a dict with 'user_id' and,
+    optionally, 'expires_in' seconds; an empty dict if verification fails.
+    Returns the previous verifier.
+    """
+    global _token_verifier
+    previous, _token_verifier = _token_verifier, verifier
+    return previous
+
+
+def _verifyToken(token, token_type):
+    """Return the user id of token, cached in-process and in memcache
+    for no longer than the token is valid."""
+    key = hashlib.sha256(token).hexdigest()
+    user_id = _token_cache.get(key)
+    if user_id:
+        return user_id
+    cached = memcache.get(MEMCACHE_TOKEN_KEY % key)
+    if cached and cached[1] > time.time():
+        _token_cache.set(key, cached[0], cached[1])
+        return cached[0]
+
+    with rpcstats.phase('tokeninfo'):
+        info = _token_verifier(token, token_type)
+    user_id = info.get('user_id', '')
+    if user_id:
+        ttl = int(info.get('expires_in') or TOKEN_CACHE_TIME)
+        expiry = time.time() + ttl
+        _token_cache.set(key, user_id, expiry)
+        memcache.set(MEMCACHE_TOKEN_KEY % key, (user_id, expiry), time=ttl)
+    return user_id
+
+
 def getUserId(user, id_type="email"):
     if id_type == "email":
         return user.email()
@@ -18,22 +123,7 @@ def getUserId(user, id_type="email"):
         token_type = 'id_token'
         if 'OAUTH_USER_ID' in os.environ:
             token_type = 'access_token'
-        url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-               % (token_type, token))
-        user = {}
-        wait = 1
-        for i in range(3):
-            resp = urlfetch.fetch(url)
-            if resp.status_code == 200:
-                user = json.loads(resp.content)
-                break
-            elif resp.status_code == 400 and 'invalid_token' in resp.content:
-                url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-                       % ('access_token', token))
-            else:
-                time.sleep(wait)
-                wait = wait + i
-        return user.get('user_id', '')
+        return _verifyToken(token, token_type)
 
     if id_type == "custom":
         # implement your own user_id creation and getting algorythm